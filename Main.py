@@ -6,8 +6,9 @@ sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 import streamlit as st
 
 from cloak.cloak_utils import display_cloak_section
-from logic.submit_handler import (get_classification_result, submit_text_input,
-                                  submit_uploaded_file)
+from logic.submit_handler import (get_classification_result,
+                                  run_pending_classification,
+                                  submit_text_input, submit_uploaded_file)
 from utils.access import check_password
 from utils.ui_helpers import create_custom_divider, set_stcode_style, show_classifications
 from utils.vectordb_helpers import load_knowledge_base
@@ -51,31 +52,42 @@ with tab2:
         submitted = st.form_submit_button(
             "Submit", on_click=submit_uploaded_file)
 
-if st.session_state.get("submitted"):
+def render_results(placeholders):
+    with placeholders["both"]:
+        create_custom_divider("both")
+    placeholders["result"].code(get_classification_result(), language=None)
+    for field in ("security", "sensitivity"):
+        with placeholders[field]:
+            create_custom_divider(field)
+        placeholders[f"{field}_classification"].code(
+            st.session_state.get(f"{field}_classification") or "N/A", language=None, wrap_lines=True)
+        placeholders[f"{field}_reasoning"].code(
+            st.session_state.get(f"{field}_reasoning") or "N/A", language=None, wrap_lines=True)
+    if "document_text" in placeholders:
+        placeholders["document_text"].markdown(st.session_state.get(
+            "document_text", ""), unsafe_allow_html=True)
+
+
+if st.session_state.get("submitted") or "pending_input" in st.session_state:
     st.divider()
     st.subheader("Classification Results")
     with st.popover("Classifications"):
         show_classifications()
-    create_custom_divider("both")
-    st.code(get_classification_result(), language=None)
+    placeholders = {"both": st.empty(), "result": st.empty()}
 
     col1, col2 = st.columns(2, border=True)
 
     with col1:
         st.subheader("Security Classification Reasoning")
-        create_custom_divider("security")
-        st.code(st.session_state.get("security_classification", "N/A"),
-                language=None, wrap_lines=True)
-        st.code(st.session_state.get("security_reasoning", "N/A"),
-                language=None, wrap_lines=True)
+        placeholders["security"] = st.empty()
+        placeholders["security_classification"] = st.empty()
+        placeholders["security_reasoning"] = st.empty()
 
     with col2:
         st.subheader("Sensitivity Classification Reasoning")
-        create_custom_divider("sensitivity")
-        st.code(st.session_state.get("sensitivity_classification",
-                "N/A"), language=None, wrap_lines=True)
-        st.code(st.session_state.get("sensitivity_reasoning", "N/A"),
-                language=None, wrap_lines=True)
+        placeholders["sensitivity"] = st.empty()
+        placeholders["sensitivity_classification"] = st.empty()
+        placeholders["sensitivity_reasoning"] = st.empty()
 
     last_submitted_mode = st.session_state.get("submitted_mode")
     if last_submitted_mode == "text" or (last_submitted_mode == "file" and st.session_state.get("file_extension") == ".txt"):
@@ -83,10 +95,16 @@ if st.session_state.get("submitted"):
         st.subheader("Downgrade your classification")
         st.write("Potentially damaging parts of the text are highlighted in bold.")
         with st.container(border=True):
-            st.markdown(st.session_state.get(
-                "document_text", ""), unsafe_allow_html=True)
+            placeholders["document_text"] = st.empty()
 
-    st.divider()
-    display_cloak_section()
+    if "pending_input" in st.session_state:
+        # Fields are drawn into the placeholders as the model generates them
+        run_pending_classification(lambda: render_results(placeholders))
+    else:
+        render_results(placeholders)
+
+    if st.session_state.get("submitted"):
+        st.divider()
+        display_cloak_section()
 
 load_knowledge_base()
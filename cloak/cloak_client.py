@@ -0,0 +1,257 @@
+import datetime
+import hashlib
+import hmac
+import json
+import math
+import os
+import threading
+import time
+import urllib.parse
+from collections import deque
+from functools import lru_cache
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# HTTP client for the Cloak API. One pooled session is shared by every
+# request, so connections are kept alive instead of paying a TCP and TLS
+# handshake per call. The signing key only changes with the date, so it is
+# derived once per day and service.
+
+CLOAK_CONNECT_TIMEOUT = float(os.getenv("CLOAK_CONNECT_TIMEOUT", "3"))
+CLOAK_TIMEOUT = float(os.getenv("CLOAK_TIMEOUT", "10"))
+CLOAK_RETRIES = int(os.getenv("CLOAK_RETRIES", "2"))
+CLOAK_BACKOFF = float(os.getenv("CLOAK_BACKOFF", "0.5"))
+CLOAK_POOL_SIZE = 10
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def generate_signature(http_method, path, query_params, headers, payload, private_key, service):
+    # Generate Signature
+
+    # Ensure query_params is a dictionary
+    query_params = query_params if query_params else {}
+
+    # Step 1: Create the canonical request
+    canonical_uri = urllib.parse.quote(path, safe="/")
+    canonical_querystring = "&".join(
+        f"{urllib.parse.quote(k, safe='')}={urllib.parse.quote(v, safe='')}"
+        for k, v in sorted(query_params.items())
+    )
+    signed_headers = sorted(headers.keys())
+    canonical_headers = "".join(
+        f"{k.lower()}:{v.strip()}\n" for k, v in sorted(headers.items())
+    )
+    signed_headers_string = ";".join(k.lower() for k in signed_headers)
+
+    if isinstance(payload, dict):
+        payload_str = json.dumps(payload, separators=(
+            ",", ":"), sort_keys=True)  # Ensure consistent key order
+        payload_bytes = payload_str.encode("utf-8")
+        payload_hash = hashlib.sha256(payload_bytes).hexdigest()
+    else:
+        payload_hash = hashlib.sha256(payload).hexdigest()
+
+    canonical_request = (
+        f"{http_method}\n"
+        f"{canonical_uri}\n"
+        f"{canonical_querystring}\n"
+        f"{canonical_headers}\n"
+        f"{signed_headers_string}\n"
+        f"{payload_hash}"
+    )
+    # Step 2: Create the string to sign
+    algorithm = "CLOAK-AUTH"
+    # formatted_date = datetime.date.today().strftime("%Y%m%d") + "T000000Z"
+    formatted_date = datetime.datetime.now(
+        datetime.timezone.utc).strftime("%Y%m%d") + "T000000Z"
+    date_stamp = formatted_date[:8]
+
+    string_to_sign = (
+        f"{algorithm}\n"
+        f"{formatted_date}\n"
+        f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+    )
+    # Step 3: Calculate the signing key, only once per day and service
+    signing_key = derive_signing_key(private_key, date_stamp, service)
+
+    # Step 4: Calculate the signature
+    signature = hmac.new(signing_key, string_to_sign.encode(
+        "utf-8"), hashlib.sha256).hexdigest()
+
+    return signature
+
+
+@lru_cache(maxsize=32)
+def derive_signing_key(private_key, date_stamp, service):
+    def sign(key, msg):
+        return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+    date_key = sign(("CLOAK-AUTH" + private_key).encode("utf-8"), date_stamp)
+    date_service_key = sign(date_key, service)
+    return sign(date_service_key, "cloak_request")
+
+
+def extract_url_info(url):
+    # Extract URL Information
+    parsed_url = urllib.parse.urlparse(url)
+    path = parsed_url.path
+    query_params = urllib.parse.parse_qs(parsed_url.query)
+    # Convert query_params values from list to single value
+    query_params = {k: v[0] for k, v in query_params.items()}
+    return path, query_params
+
+
+class CloakClient:
+
+    def __init__(self, base_url, public_key, private_key, service="fta",
+                 timeout=(CLOAK_CONNECT_TIMEOUT, CLOAK_TIMEOUT), retries=CLOAK_RETRIES,
+                 backoff=CLOAK_BACKOFF, pool_size=CLOAK_POOL_SIZE, verify=False):
+        self.base_url = base_url
+        self.public_key = public_key
+        self.private_key = private_key
+        self.service = service
+        self.timeout = timeout
+        self.verify = verify
+        self.session = requests.Session()
+        # Analyze and transform have no side effects, so POSTs are retried too
+        retry = Retry(total=retries, backoff_factor=backoff, allowed_methods=None,
+                      status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def post(self, endpoint, payload):
+        url = f"{self.base_url}/{endpoint}"
+        path, query_params = extract_url_info(url)
+        signed_headers = {
+            "Content-Type": "application/json"
+        }
+        signature = generate_signature(
+            "POST", path, query_params, signed_headers, payload, self.private_key, self.service)
+        authorization = f"CLOAK-AUTH Credential={self.public_key},SignedHeaders=Content-Type,Signature={signature}"
+        headers = {"Content-Type": "application/json", "Accept": "application/json",
+                   "Authorization": authorization, "x-cloak-service": self.service}
+
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = self.session.post(url, headers=headers, json=payload,
+                                         verify=self.verify, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+            failed = False
+            return result
+        finally:
+            self._record(endpoint, time.perf_counter() - start, failed)
+
+    def analyze(self, payload):
+        return self.post("analyze", payload)
+
+    def transform(self, payload):
+        return self.post("transform", payload)
+
+    def metrics(self):
+        # {endpoint: count, errors, total, max, p50 and p95 seconds}, including
+        # the time spent on retries. The percentiles are over the most recent
+        # 1000 requests.
+        with self._lock:
+            metrics = {}
+            for endpoint, value in self._metrics.items():
+                samples = sorted(value["samples"])
+                metrics[endpoint] = {
+                    "count": value["count"],
+                    "errors": value["errors"],
+                    "total_seconds": value["total_seconds"],
+                    "max_seconds": value["max_seconds"],
+                    "p50_seconds": _percentile(samples, 0.5),
+                    "p95_seconds": _percentile(samples, 0.95),
+                }
+            return metrics
+
+    def close(self):
+        self.session.close()
+
+    def _record(self, endpoint, seconds, failed):
+        with self._lock:
+            value = self._metrics.setdefault(
+                endpoint, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                           "samples": deque(maxlen=1000)})
+            value["count"] += 1
+            value["errors"] += failed
+            value["total_seconds"] += seconds
+            value["max_seconds"] = max(value["max_seconds"], seconds)
+            value["samples"].append(seconds)
+
+
+def _percentile(sorted_samples, fraction):
+    # Nearest-rank percentile
+    rank = max(math.ceil(fraction * len(sorted_samples)), 1)
+    return sorted_samples[rank - 1]
+
+
+if __name__ == "__main__":
+    # Benchmark against a local stand-in server that checks the signatures:
+    # python -m cloak.cloak_client
+    import socket
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    public_key, private_key = "public", "private"
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            # Headers and body are written separately, which would otherwise
+            # wait on delayed ACKs over a kept-alive connection
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            path, query_params = extract_url_info(self.path)
+            expected = generate_signature("POST", path, query_params, {"Content-Type": "application/json"},
+                                          payload, private_key, self.headers["x-cloak-service"])
+            valid = self.headers["Authorization"].endswith(f"Signature={expected}")
+            body = json.dumps({"text": payload["text"]} if valid else {"error": "bad signature"}).encode()
+            self.send_response(200 if valid else 401)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/prod/L4"
+    requests_count = 200
+    payload = {"text": "NRIC S1234567D", "language": "en"}
+
+    def unpooled_post():
+        path, query_params = extract_url_info(f"{base_url}/analyze")
+        signature = generate_signature("POST", path, query_params, {"Content-Type": "application/json"},
+                                       payload, private_key, "fta")
+        headers = {"Content-Type": "application/json", "x-cloak-service": "fta",
+                   "Authorization": f"CLOAK-AUTH Credential={public_key},SignedHeaders=Content-Type,Signature={signature}"}
+        requests.post(f"{base_url}/analyze", headers=headers, json=payload, timeout=5).raise_for_status()
+
+    client = CloakClient(base_url, public_key, private_key)
+    for name, post in (("requests.post", unpooled_post), ("CloakClient", lambda: client.analyze(payload))):
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            post()
+        print(f"{name}: {(time.perf_counter() - start) / requests_count * 1000:.2f} ms per request")
+    print(client.metrics())
+
+    try:
+        CloakClient(base_url, public_key, "wrong key").analyze(payload)
+    except requests.HTTPError as error:
+        print(f"Wrong key rejected: {error}")
+    server.shutdown()
@@ -0,0 +1,63 @@
+from utils.pii_detector import detect_entities
+
+# Offline stand-in for the Cloak analyze and transform endpoints. It takes the
+# same payloads and returns results in the same shape, for the entities that
+# can be detected from their format (see utils/pii_detector.py). Entities such
+# as PERSON are only found by the Cloak API.
+
+
+def analyze(payload):
+    allow_list = set(payload.get("allow_list") or [])
+    text = payload["text"]
+    return [result for result in detect_entities(text, payload.get("entities"),
+                                                 payload.get("score_threshold", 0.0))
+            if text[result["start"]:result["end"]] not in allow_list]
+
+
+def transform(payload):
+    return transform_results(payload["text"], analyze(payload), payload.get("anonymizers", {}))
+
+
+def transform_results(text, results, anonymizers):
+    # Applies the anonymizers to entities that were already found
+    return {"text": anonymize(text, results, anonymizers),
+            "items": [dict(result, operator=anonymizers.get(result["entity_type"], {}).get("type", "replace"))
+                      for result in results]}
+
+
+def anonymize(text, results, anonymizers):
+    # Each occurrence of the same value gets the same alias, numbered in order
+    # of first appearance for each entity type
+    aliases = {}
+    result = ""
+    index = 0
+    for item in sorted(results, key=lambda item: item["start"]):
+        if item["start"] < index:
+            continue
+        entity_type = item["entity_type"]
+        value = text[item["start"]:item["end"]]
+        settings = anonymizers.get(entity_type, {"type": "replace"})
+        result += text[index:item["start"]]
+        result += apply_anonymizer(value, entity_type, settings, aliases)
+        index = item["end"]
+    result += text[index:]
+    return result
+
+
+def apply_anonymizer(value, entity_type, settings, aliases):
+    technique = settings.get("type", "replace")
+    if technique == "redact":
+        return ""
+    if technique == "mask":
+        count = min(int(settings.get("chars_to_mask", len(value))), len(value))
+        masking_char = settings.get("masking_char") or "*"
+        if settings.get("from_end", True):
+            return value[:len(value) - count] + masking_char * count
+        return masking_char * count + value[count:]
+    if technique == "alias":
+        key = (entity_type, value)
+        if key not in aliases:
+            number = sum(1 for other_type, _ in aliases if other_type == entity_type) + 1
+            aliases[key] = f"<{entity_type}_{number}>"
+        return aliases[key]
+    return settings.get("new_value", f"<{entity_type}>")
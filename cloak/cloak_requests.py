@@ -1,18 +1,23 @@
-import datetime
+import copy
 import hashlib
-import hmac
 import json
 import os
+import threading
 import time
-import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 import pandas as pd
 import requests
 import streamlit as st
-import urllib3
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
+from cloak import cloak_local
+from cloak.cloak_client import CloakClient, extract_url_info, generate_signature
+from cloak.cloak_windows import merge_window_results, split_windows
+from utils.highlight import bold_spans
+
 if load_dotenv(".env"):
     # for local development
     CLOAK_PRIVATE_KEY = os.getenv("CLOAK_PRIVATE_KEY")
@@ -22,95 +27,30 @@ else:
     CLOAK_PUBLIC_KEY = st.secrets.get("CLOAK_PUBLIC_KEY")
 
 base_url = "https://ext-api.cloak.gov.sg/prod/L4"
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-
-def generate_signature(http_method, path, query_params, headers, payload, private_key, service):
-    # Generate Signature
-
-    # Ensure query_params is a dictionary
-    query_params = query_params if query_params else {}
-
-    # Step 1: Create the canonical request
-    canonical_uri = urllib.parse.quote(path, safe="/")
-    canonical_querystring = "&".join(
-        f"{urllib.parse.quote(k, safe='')}={urllib.parse.quote(v, safe='')}"
-        for k, v in sorted(query_params.items())
-    )
-    signed_headers = sorted(headers.keys())
-    canonical_headers = "".join(
-        f"{k.lower()}:{v.strip()}\n" for k, v in sorted(headers.items())
-    )
-    signed_headers_string = ";".join(k.lower() for k in signed_headers)
-
-    if isinstance(payload, dict):
-        payload_str = json.dumps(payload, separators=(
-            ",", ":"), sort_keys=True)  # Ensure consistent key order
-        payload_bytes = payload_str.encode("utf-8")
-        payload_hash = hashlib.sha256(payload_bytes).hexdigest()
-    else:
-        payload_hash = hashlib.sha256(payload).hexdigest()
-
-    canonical_request = (
-        f"{http_method}\n"
-        f"{canonical_uri}\n"
-        f"{canonical_querystring}\n"
-        f"{canonical_headers}\n"
-        f"{signed_headers_string}\n"
-        f"{payload_hash}"
-    )
-    # Step 2: Create the string to sign
-    algorithm = "CLOAK-AUTH"
-    # formatted_date = datetime.date.today().strftime("%Y%m%d") + "T000000Z"
-    formatted_date = datetime.datetime.now(
-        datetime.timezone.utc).strftime("%Y%m%d") + "T000000Z"
-    date_stamp = formatted_date[:8]
-
-    string_to_sign = (
-        f"{algorithm}\n"
-        f"{formatted_date}\n"
-        f"{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
-    )
-    # Step 3: Calculate the signing key
-
-    def sign(key, msg):
-        return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
-
-    date_key = sign(("CLOAK-AUTH" + private_key).encode("utf-8"), date_stamp)
-    date_service_key = sign(date_key, service)
-    signing_key = sign(date_service_key, "cloak_request")
-
-    # Step 4: Calculate the signature
-    signature = hmac.new(signing_key, string_to_sign.encode(
-        "utf-8"), hashlib.sha256).hexdigest()
-
-    return signature
-
-
-def extract_url_info(url):
-    # Extract URL Information
-    parsed_url = urllib.parse.urlparse(url)
-    path = parsed_url.path
-    query_params = urllib.parse.parse_qs(parsed_url.query)
-    # Convert query_params values from list to single value
-    query_params = {k: v[0] for k, v in query_params.items()}
-    return path, query_params
+# "remote" for the Cloak API or "local" for the offline engine in cloak_local.py.
+# With the remote backend, requests that time out or fail fall back to the
+# local engine only when CLOAK_LOCAL_FALLBACK is set, since it cannot detect
+# entities such as PERSON or SG_ADDRESS. Results then have "backend": "local".
+CLOAK_BACKEND = os.getenv("CLOAK_BACKEND", "remote")
+CLOAK_LOCAL_FALLBACK = os.getenv("CLOAK_LOCAL_FALLBACK", "false").lower() == "true"
+# Texts longer than CLOAK_WINDOW_CHARS are sent in overlapping windows,
+# CLOAK_MAX_WORKERS at a time
+CLOAK_WINDOW_CHARS = int(os.getenv("CLOAK_WINDOW_CHARS", "5000"))
+CLOAK_WINDOW_OVERLAP = 200
+CLOAK_MAX_WORKERS = int(os.getenv("CLOAK_MAX_WORKERS", "4"))
+# Cloak results are cached per process, so reruns and other sessions sending
+# the same text with the same settings make no request
+CLOAK_CACHE_SIZE = int(os.getenv("CLOAK_CACHE_SIZE", "512"))
+CLOAK_CACHE_TTL = float(os.getenv("CLOAK_CACHE_TTL", "3600"))
+
+_result_cache = TTLCache(maxsize=CLOAK_CACHE_SIZE, ttl=CLOAK_CACHE_TTL)
+_result_cache_lock = threading.Lock()
+_cache_counts = {"hits": 0, "misses": 0}
 
 
 def downgrade_classification(text):
-    analyse_result = cloak_analyse(text)
-
-    result = ""
-    index = 0
-    for identifier in sorted(analyse_result, key=lambda x: x["start"]):
-        start_index = identifier["start"]
-        end_index = identifier["end"]
-        result += text[index:start_index]
-        result += f"**{text[start_index:end_index]}**"
-        index = end_index
-    result += text[index:len(text)]
-    return result
+    analyse_result, _ = cloak_analyse(text)
+    return bold_spans(text, [(identifier["start"], identifier["end"]) for identifier in analyse_result])
 
 
 def cloak_it(text):
@@ -118,7 +58,6 @@ def cloak_it(text):
 
 
 def cloak_analyse(text):
-    url = f"{base_url}/analyze"
     payload = {
         "text": text,
         "language": "en",
@@ -138,51 +77,97 @@ def cloak_analyse(text):
             }
         }
     }
-    #####################
-    http_method = "POST"
-    service = "fta"
-
-    path, query_params = extract_url_info(url)
-
-    signed_headers = {
-        "Content-Type": "application/json"
-    }
-
-    signature = generate_signature(
-        http_method, path, query_params, signed_headers, payload, CLOAK_PRIVATE_KEY, service)
-    authorization = f"CLOAK-AUTH Credential={CLOAK_PUBLIC_KEY},SignedHeaders=Content-Type,Signature={signature}"
-    headers = {"Content-Type": "application/json", "Accept": "application/json",
-               "Authorization": f"{authorization}", "x-cloak-service": f"{service}"}
-    response = requests.post(url, headers=headers, json=payload, verify=False)
-    #####################
-    # pprint(response.json())
-    analyzer_results = response.json()
-    return analyzer_results
+    # Returns the results and the backend that produced them
+    return analyse_payload(payload)
 
 
 def cloak_transform(text):
     # FTA Transform Endpoint
-    url = f"{base_url}/transform"
     payload = form_transform_payload(text)
 
-    #####################
-    http_method = "POST"
-    service = "fta"
-
-    path, query_params = extract_url_info(url)
-    signed_headers = {
-        "Content-Type": "application/json"
-    }
-    signature = generate_signature(
-        http_method, path, query_params, signed_headers, payload, CLOAK_PRIVATE_KEY, service)
-    authorization = f"CLOAK-AUTH Credential={CLOAK_PUBLIC_KEY},SignedHeaders=Content-Type,Signature={signature}"
-    headers = {"Content-Type": "application/json", "Accept": "application/json",
-               "Authorization": f"{authorization}", "x-cloak-service": f"{service}"}
-    response = requests.post(url, headers=headers, json=payload, verify=False)
-    #####################
-    # pprint(response.json())
-    transform_results = response.json()
-    return transform_results
+    if use_local_backend():
+        result, backend = cloak_local.transform(payload), "local"
+    elif len(text) > CLOAK_WINDOW_CHARS:
+        # Long texts are analyzed window by window and anonymized here, so the
+        # same value gets the same alias in every window
+        analyse_only = {key: value for key, value in payload.items() if key != "anonymizers"}
+        results, backend = analyse_payload(analyse_only)
+        result = cloak_local.transform_results(text, results, payload["anonymizers"])
+    else:
+        result, backend = post_with_fallback("transform", payload, cloak_local.transform)
+    return dict(result, backend=backend)
+
+
+def analyse_payload(payload):
+    if use_local_backend():
+        return cloak_local.analyze(payload), "local"
+    if len(payload["text"]) > CLOAK_WINDOW_CHARS:
+        return analyse_windows(payload)
+    return post_with_fallback("analyze", payload, cloak_local.analyze)
+
+
+def analyse_windows(payload):
+    # Windows are sent concurrently, at most CLOAK_MAX_WORKERS at a time
+    text = payload["text"]
+    windows = split_windows(text, CLOAK_WINDOW_CHARS, CLOAK_WINDOW_OVERLAP)
+    client = get_cloak_client()
+    with ThreadPoolExecutor(max_workers=CLOAK_MAX_WORKERS) as executor:
+        window_results = list(executor.map(
+            lambda window: post_with_fallback("analyze", dict(payload, text=window[1]), cloak_local.analyze, client),
+            windows))
+    # A single window sent to the local engine weakens the whole result
+    backend = "local" if any(backend == "local" for _, backend in window_results) else "remote"
+    return merge_window_results(text, windows, [results for results, _ in window_results]), backend
+
+
+def post_with_fallback(endpoint, payload, local_engine, client=None):
+    # Returns the result and the backend that produced it. Results of the
+    # Cloak API are cached, results of the local fallback are not.
+    key = cache_key(endpoint, payload)
+    with _result_cache_lock:
+        cached = _result_cache.get(key)
+        _cache_counts["hits" if cached is not None else "misses"] += 1
+    if cached is not None:
+        return copy.deepcopy(cached), "remote"
+
+    client = client or get_cloak_client()
+    try:
+        result = client.post(endpoint, payload)
+    except requests.RequestException:
+        if not CLOAK_LOCAL_FALLBACK:
+            raise
+        return local_engine(payload), "local"
+    with _result_cache_lock:
+        _result_cache[key] = copy.deepcopy(result)
+    return result, "remote"
+
+
+def cache_key(endpoint, payload):
+    # The payload holds the text and the anonymizer settings, serialized with
+    # sorted keys so equal settings give the same key
+    normalized = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return endpoint, hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def get_cloak_cache_stats():
+    with _result_cache_lock:
+        hits, misses = _cache_counts["hits"], _cache_counts["misses"]
+        return {"hits": hits, "misses": misses, "size": len(_result_cache),
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+
+
+def use_local_backend():
+    return CLOAK_BACKEND == "local"
+
+
+@st.cache_resource
+def get_cloak_client():
+    # The local engine misses entities the API finds, so missing keys are an
+    # error rather than a reason to switch to it
+    if not (CLOAK_PRIVATE_KEY and CLOAK_PUBLIC_KEY):
+        raise RuntimeError("CLOAK_PRIVATE_KEY and CLOAK_PUBLIC_KEY must be set to use the Cloak API, "
+                           "or set CLOAK_BACKEND=local to use the offline engine")
+    return CloakClient(base_url, CLOAK_PUBLIC_KEY, CLOAK_PRIVATE_KEY)
 
 
 entity_parameter_mapping = {
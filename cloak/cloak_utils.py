@@ -1,6 +1,6 @@
 import streamlit as st
 from logic.submit_handler import clean_text_for_markdown
-from cloak.cloak_requests import cloak_it
+from cloak.cloak_requests import cloak_transform
 
 
 def display_cloak_setting(name, default_toggle=True, default_technique="Replace"):
@@ -66,6 +66,9 @@ def display_cloak_section():
     with st.container():
         if st.session_state.get("pressed_cloak"):
             with st.container(border=True):
-                cloak_text = cloak_it(
+                cloak_result = cloak_transform(
                     st.session_state.get("text_input", ""))
-                st.write(clean_text_for_markdown(cloak_text))
+                if cloak_result["backend"] == "local":
+                    st.warning("The text was masked offline, which cannot detect names, addresses, "
+                               "nationalities, locations or dates. Check it before sharing.")
+                st.write(clean_text_for_markdown(cloak_result["text"]))
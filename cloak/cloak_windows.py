@@ -0,0 +1,71 @@
+import re
+
+# Splits long texts into overlapping windows for the Cloak API and merges the
+# entities found in each window back onto the offsets of the full text.
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+WHITESPACE = re.compile(r"\s+")
+
+
+def split_windows(text, window_chars, overlap_chars):
+    # Returns (offset, window) pairs. Windows end on a sentence boundary where
+    # possible, and each one starts at the first sentence that begins within
+    # overlap_chars of the end of the previous one.
+    windows = []
+    start = 0
+    while start < len(text):
+        end = min(start + window_chars, len(text))
+        if end < len(text):
+            end = _last_boundary(text, start + window_chars // 2, end) or end
+        windows.append((start, text[start:end]))
+        if end >= len(text):
+            break
+        start = max(_next_boundary(text, end - overlap_chars, end) or end - overlap_chars, start + 1)
+    return windows
+
+
+def merge_window_results(text, windows, window_results):
+    # Entities at a window edge that falls inside a word may be cut off, the
+    # neighbouring window sees them whole in the overlap. Entities found in
+    # two windows are kept once.
+    merged = {}
+    for (offset, window), results in zip(windows, window_results):
+        cut_at_start = offset > 0 and not text[offset - 1].isspace()
+        cut_at_end = offset + len(window) < len(text) and not text[offset + len(window)].isspace()
+        for result in results:
+            if (cut_at_start and result["start"] == 0) or (cut_at_end and result["end"] == len(window)):
+                continue
+            shifted = dict(result, start=result["start"] + offset, end=result["end"] + offset)
+            key = (shifted["entity_type"], shifted["start"], shifted["end"])
+            if key not in merged or merged[key]["score"] < shifted["score"]:
+                merged[key] = shifted
+
+    # Of overlapping entities with different extents, the longer one is kept
+    results = []
+    for result in sorted(merged.values(), key=lambda item: (item["start"], -item["end"])):
+        if results and result["start"] < results[-1]["end"]:
+            if result["end"] - result["start"] > results[-1]["end"] - results[-1]["start"]:
+                results[-1] = result
+            continue
+        results.append(result)
+    return results
+
+
+def _last_boundary(text, low, high):
+    # End of the last sentence ending between low and high, or failing that
+    # the last word
+    boundary = None
+    for match in SENTENCE_END.finditer(text, low, high):
+        boundary = match.end()
+    if boundary is None:
+        for match in WHITESPACE.finditer(text, low, high):
+            boundary = match.end()
+    return boundary
+
+
+def _next_boundary(text, low, high):
+    # Start of the first sentence beginning between low and high, or failing
+    # that the first word
+    low = max(low, 0)
+    match = SENTENCE_END.search(text, low, high) or WHITESPACE.search(text, low, high)
+    return match.end() if match else None
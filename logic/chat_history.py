@@ -0,0 +1,82 @@
+import os
+
+import streamlit as st
+
+from utils import llm
+from utils.vectordb_helpers import count_tokens_from_messages
+
+# Keeps the chat history sent with each Q&A question within a token budget.
+# The most recent messages are sent as they are. Older messages are folded
+# into a running summary a few at a time, as they drop out of the window, so
+# the summary is never rebuilt from the whole conversation.
+
+QNA_HISTORY_TOKENS = int(os.getenv("QNA_HISTORY_TOKENS", "1500"))
+# Once over budget the window is cut down to this share of it, so the summary
+# is only updated every few turns rather than on every one
+QNA_HISTORY_LOW_WATER = 0.5
+QNA_SUMMARY_WORDS = 150
+
+summary_prompt = """
+    You are summarising a conversation between staff and a data classification assistant, so that the conversation can continue without its earlier messages.
+    Update the current summary with the new messages. Keep the questions asked, the classifications and facts given in the answers, and anything the user said about their documents.
+    Reply with the updated summary only, in at most {words} words.
+
+    <Current Summary>
+    {summary}
+    </Current Summary>
+
+    <New Messages>
+    {messages}
+    </New Messages>
+    """
+
+
+def get_history(messages, user_input, budget=QNA_HISTORY_TOKENS):
+    # Returns the chat history to send with user_input as (role, content)
+    # pairs, led by a system message with the summary of older messages. The
+    # question itself is left out, the page adds it to messages before it is
+    # answered.
+    if messages and messages[-1] == {"role": "user", "content": user_input}:
+        messages = messages[:-1]
+
+    state = st.session_state.setdefault("qna_summary", {"text": "", "count": 0})
+    if state["count"] > len(messages):
+        # The chat was cleared
+        state.update(text="", count=0)
+
+    window = messages[state["count"]:]
+    if count_tokens_from_messages(window) > budget:
+        cut = window_start(window, budget * QNA_HISTORY_LOW_WATER)
+        state["text"] = llm.summarize_conversation(summary_prompt, state["text"], window[:cut], QNA_SUMMARY_WORDS)
+        state["count"] += cut
+        window = window[cut:]
+
+    history = [("system", f"Summary of the earlier conversation:\n{state['text']}")] if state["text"] else []
+    return history + [("user" if message["role"] == "user" else "assistant", message["content"])
+                      for message in window]
+
+
+def window_start(messages, budget):
+    # Index of the oldest message from which the rest fit within budget
+    total = 0
+    for index in range(len(messages) - 1, -1, -1):
+        total += count_tokens_from_messages([messages[index]])
+        if total > budget:
+            return index + 1
+    return 0
+
+
+def get_standalone_question(retriever_system_prompt, user_input, history):
+    # The first question of a conversation is used as it is, without a
+    # rewrite call
+    if not has_earlier_turns(history):
+        return user_input
+    return llm.get_standalone_question(retriever_system_prompt, user_input, history)
+
+
+def has_earlier_turns(history):
+    return any(role in ("user", "system") for role, _ in history)
+
+
+def clear_history():
+    st.session_state.pop("qna_summary", None)
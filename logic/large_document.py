@@ -0,0 +1,47 @@
+from utils.token_splitter import TokenOffsetTextSplitter, get_encoding
+from utils.ui_helpers import classification_rank
+
+# Documents longer than LARGE_DOCUMENT_TOKENS are split into sections that are
+# classified concurrently. The document takes the highest classification of
+# any section, and keeps the reasoning and sensitive spans of every section.
+
+LARGE_DOCUMENT_TOKENS = 3000
+SECTION_TOKENS = 2000
+
+section_splitter = TokenOffsetTextSplitter(
+    separators=["\n\n", "\n", ". ", " ", ""],
+    chunk_size=SECTION_TOKENS,
+    chunk_overlap=0,
+)
+
+
+def is_large_document(text):
+    return len(get_encoding().encode(text, disallowed_special=())) > LARGE_DOCUMENT_TOKENS
+
+
+def split_sections(text):
+    return section_splitter.split_text(text)
+
+
+def reduce_sections(section_results, section_count=None):
+    # section_results holds the parsed answer of each section in document
+    # order, None for sections that are still being classified
+    section_count = section_count or len(section_results)
+    finished = [(index, result) for index, result in enumerate(section_results) if result is not None]
+
+    reduced = {"sensitive_spans": []}
+    for scale in ("security", "sensitivity"):
+        field = f"{scale}_classification"
+        highest = max((result.get(field) or "" for _, result in finished),
+                      key=classification_rank, default="")
+        reduced[field] = highest
+        reduced[f"{scale}_reasoning"] = "\n\n".join(
+            f"Section {index + 1} of {section_count} ({result.get(field) or 'N/A'}): "
+            f"{result.get(f'{scale}_reasoning', '')}"
+            for index, result in finished)
+
+    for _, result in finished:
+        spans = result.get("sensitive_spans")
+        if isinstance(spans, list):
+            reduced["sensitive_spans"].extend(spans)
+    return reduced
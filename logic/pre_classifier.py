@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import threading
+
+from utils.pii_detector import detect_entities
+
+# Runs before the LLM. Identifiers found by the local detectors are passed to
+# the classification prompt as hints. With the "short_circuit" policy, short
+# inputs with no identifiers, no sensitive terms, no numbers and no word that
+# could be a name get a low classification without any LLM call.
+
+# "off", "hints" or "short_circuit"
+PRECLASSIFY_POLICY = os.getenv("PRECLASSIFY_POLICY", "hints")
+HINT_SCORE_THRESHOLD = 0.5
+SHORT_CIRCUIT_MAX_WORDS = 60
+SHORT_CIRCUIT_CLASSIFICATION = ("Class Dark Green", "S1")
+
+# Stems of terms that can make a text sensitive without containing any
+# identifier, matched at the start of a word so that "diagnosed" matches
+# "diagnos" and "salaries" matches "salar"
+SENSITIVE_STEMS = """
+account acquisi address apprais audit bank birth budget claim classified
+confidential contract credential diagnos disciplin earning financ forecast
+health hospital investigat legal live medic merger minutes nric passcode
+passport password patient payroll perform personal policyholder private profit
+proposal resid restricted revenue salar secret sensitiv strateg
+""".split()
+SENSITIVE_TERM = re.compile(r"\b(?:" + "|".join(SENSITIVE_STEMS) + ")", re.IGNORECASE)
+WORD_PATTERN = re.compile(r"[a-z]+")
+# Names and addresses are not detected locally. Any capitalised word could be
+# a name, except a common word starting a sentence, and any digit could be
+# part of an address, so either rules out a short circuit.
+CAPITALISED_WORD = re.compile(r"\b[A-Z][\w'-]*")
+COMMON_SENTENCE_STARTS = frozenset("""
+A All An Any Are As At Can Could Do Does For From Here How I If In Is It Let
+No Not Our Please So That The There These They This Those To We What When
+Where Which Why Will With Would Yes You Your
+""".split())
+DIGIT = re.compile(r"\d")
+SALUTATION = re.compile(
+    r"^\s*(?:Dear|Hi|Hello|Hey|(?:Best |Kind |Warm )?Regards|Sincerely|Yours (?:sincerely|faithfully|truly)|Cheers)\b",
+    re.IGNORECASE | re.MULTILINE)
+
+stats = {"checked": 0, "short_circuited": 0}
+_stats_lock = threading.Lock()
+
+
+def pre_classify(text, policy=PRECLASSIFY_POLICY, allow_short_circuit=True):
+    # Returns (entities, response). response is only set when the input was
+    # short-circuited, in the same shape as the RAG response.
+    if policy == "off":
+        return [], None
+    entities = detect_entities(text)
+    short_circuit = policy == "short_circuit" and allow_short_circuit and not entities and is_trivial(text)
+    with _stats_lock:
+        stats["checked"] += 1
+        stats["short_circuited"] += short_circuit
+    if short_circuit:
+        return entities, short_circuit_response(text)
+    return [entity for entity in entities if entity["score"] >= HINT_SCORE_THRESHOLD], None
+
+
+def is_trivial(text):
+    words = WORD_PATTERN.findall(text.lower())
+    return (0 < len(words) <= SHORT_CIRCUIT_MAX_WORDS and SENSITIVE_TERM.search(text) is None
+            and DIGIT.search(text) is None and not mentions_person(text))
+
+
+def mentions_person(text):
+    return SALUTATION.search(text) is not None or any(
+        is_name_like(text, match) for match in CAPITALISED_WORD.finditer(text))
+
+
+def is_name_like(text, match):
+    if match.group() == "I":
+        return False
+    before = text[:match.start()].rstrip()
+    starts_sentence = not before or before[-1] in ".!?:\n"
+    return not (starts_sentence and match.group() in COMMON_SENTENCE_STARTS)
+
+
+def entity_signature(text):
+    # The kinds of identifiers in a text, to tell apart texts that are
+    # otherwise alike
+    return ",".join(sorted({entity["entity_type"]
+                            for entity in detect_entities(text, score_threshold=HINT_SCORE_THRESHOLD)}))
+
+
+def format_hints(text, entities, policy=PRECLASSIFY_POLICY):
+    # policy must be the one pre_classify ran with
+    if policy == "off":
+        return "Not checked."
+    if not entities:
+        return "None detected."
+    return "\n".join(f"- {entity['entity_type']}: {text[entity['start']:entity['end']]}"
+                     for entity in entities)
+
+
+def short_circuit_response(text):
+    security, sensitivity = SHORT_CIRCUIT_CLASSIFICATION
+    answer = {
+        "security_classification": security,
+        "sensitivity_classification": sensitivity,
+        "security_reasoning": "No identifiers or sensitive terms were detected in this short text, "
+                              "so it was classified locally without the language model.",
+        "sensitivity_reasoning": "No information that can identify an individual or another entity was detected.",
+        "sensitive_spans": [],
+    }
+    return {"input": text, "question": text, "context": [], "answer": json.dumps(answer)}
@@ -1,6 +1,29 @@
+import hashlib
+import json
+import os
+import threading
+
 import streamlit as st
 
+from logic.chat_history import get_history, get_standalone_question
+from logic.pre_classifier import HINT_SCORE_THRESHOLD, entity_signature, format_hints, pre_classify
 from utils import llm
+from utils.classification_cache import ClassificationCache
+from utils.faq_cache import FAQCache, question_signature
+from utils.highlight import find_spans
+from utils.pii_detector import detect_entities
+from utils.vectordb_helpers import knowledge_base_version
+
+# Reuse classification results of identical or near-identical inputs
+CLASSIFICATION_CACHE = os.getenv("CLASSIFICATION_CACHE", "true").lower() == "true"
+# Answer recurring Q&A questions from earlier answers, without any LLM call
+FAQ_CACHE = os.getenv("FAQ_CACHE", "true").lower() == "true"
+FAQ_CACHE_THRESHOLD = float(os.getenv("FAQ_CACHE_THRESHOLD", "0.95"))
+FAQ_CACHE_TTL = float(os.getenv("FAQ_CACHE_TTL", str(7 * 24 * 3600)))
+FAQ_CACHE_MAX_ENTRIES = 1000
+# Answer the questions listed in FAQ_QUESTIONS_PATH when the Q&A page is first opened
+FAQ_PREWARM = os.getenv("FAQ_PREWARM", "false").lower() == "true"
+FAQ_QUESTIONS_PATH = "data/faq_questions.txt"
 
 classify_retriever_prompt = """
     You are an AI language model assistant helping with retrieving information about how to classify an original text by security and sensitivity.
@@ -33,7 +56,14 @@ classify_prompt = """
     2. Using the External Sensitivity Framework (ESF) from the context, think about and provide a detailed reasoning for the sensitivity classification of the document. \
         Sensitivity classifications, from lowest to highest, are: S1, S2, S3. \
         Remember, only when the information can be used to identify an individual or entity(other than the company) then will it be higher than S1.
-    3. Bold and return the parts of the original text that should be annoymised to have a lower security and / or sensitivity classification. If there are no parts to annoymise, return the original text.
+    3. List the parts of the original text that should be annoymised to have a lower security and / or sensitivity classification, each quoted exactly as it appears in the original text. If there are no parts to annoymise, return an empty list.
+
+    Identifiers found in the document by a pattern detector are listed in the Detected Entities tags. Use them as hints: \
+        they are not a classification by themselves, and the document may contain identifiers the detector missed.
+
+    <Detected Entities>
+    {hints}
+    </Detected Entities>
 
     Think through your tasks step-by-step and provide a detailed reasoning for both security and sensitivity classifications.
     Do not use other classifications or frameworks outside of the SCF and ESF.
@@ -43,8 +73,8 @@ classify_prompt = """
         security_classification: < Your security classification here > ,
         sensitivity_classification: < Your sensitivity classification here > ,
         security_reasoning: < Your reasoning for your security classification here > ,
-        sensitivity_reasoning: < Your reasoning for your sensitivity classification here >
-        document_text: < The text of the document with the parts that can be annoymised to have a lower security and sensitivity classification in **bold**, or the original text if none. 
+        sensitivity_reasoning: < Your reasoning for your sensitivity classification here > ,
+        sensitive_spans: < A list of the exact parts of the document that can be annoymised to have a lower security and sensitivity classification, or an empty list if none. Do not repeat the rest of the document. > 
 
     Review the inputs and outputs, delimited by example tags, for extra examples.
     <Examples>
@@ -54,7 +84,7 @@ classify_prompt = """
         "sensitivity_classification": "S2",
         "security_reasoning": "The document contains personal information that is not publicly available but does not pose a significant risk if disclosed.",
         "sensitivity_reasoning": "The document contains an address that can be identified as belonging to a specific individual, thus requiring a higher sensitivity classification.",
-        "document_text": "This is a confidential document containing personal information about **John Doe**, who lives at **123 Main Street, Singapore**."
+        "sensitive_spans": ["John Doe", "123 Main Street, Singapore"]
         
     Original Text: What are the company policies regarding data handling?
     Answer:
@@ -62,7 +92,7 @@ classify_prompt = """
         "sensitivity_classification": "S1",
         "security_reasoning": "The document contains a general query, no information requiring higher security classifications has been disclosed yet.",
         "sensitivity_reasoning": "The document does not contain sensitive information.",
-        "document_text": "What are the company policies regarding data handling?"
+        "sensitive_spans": []
 
     Original Text: This report contains our company's financial data for the fiscal year 2022. Annual Revenue: $1, 000, 000. Profit: $200, 000.
     Answer:
@@ -70,7 +100,7 @@ classify_prompt = """
         "sensitivity_classification": "S1",
         "security_reasoning": "The document contains the company's financial information that is not publicly available.",
         "sensitivity_reasoning": "The document contains the company's financial data, not the financial data of individuals or other entities besides the company.",
-        "document_text": "This report contains our company's financial data for the fiscal year **2022**. **Annual Revenue: $1,000,000. Profit: $200,000**."
+        "sensitive_spans": ["2022", "Annual Revenue: $1, 000, 000. Profit: $200, 000."]
 
     Original Text: Minutes from the last board meeting held on 1st January 2023. Chairman has approved the proposal for expansion into new markets.
     Answer:
@@ -78,7 +108,7 @@ classify_prompt = """
         "sensitivity_classification": "S1",
         "security_reasoning": "The document contains information about a board meeting that is not publicly available yet. The information might cause serious damage to the company when disclosed, but not very serious enough to warrant a higher security classification yet.",
         "sensitivity_reasoning": "The document contains information about a board meeting that is not publicly available, but does not contain any information that can negatively impact individuals or other entities besides the company.",
-        "document_text": "Minutes from the last board meeting held on **1st January 2023**. **Chairman has approved the proposal for expansion into new markets.**"
+        "sensitive_spans": ["1st January 2023", "Chairman has approved the proposal for expansion into new markets."]
 
     Original Text: We will have a teambuilding event next week, Mon, 2PM-5PM at the event hall.
     Answer:
@@ -86,7 +116,7 @@ classify_prompt = """
         "sensitivity_classification": "S1",
         "security_reasoning": "The document contains information about a staff event, which will not negatively affect the compant even if disclosed.",
         "sensitivity_reasoning": "The document does not contain sensitive information.",
-        "document_text": "We will have a teambuilding event next week, Mon, 2PM-5PM at the event hall."
+        "sensitive_spans": []
 
     Original Text: The password for the company database is 'password123'. Please do not share it with anyone.
     Answer:
@@ -94,7 +124,7 @@ classify_prompt = """
         "sensitivity_classification": "S1",
         "security_reasoning": "The document contains sensitive information that, if disclosed, could lead to unauthorized access to the company's database.",
         "sensitivity_reasoning": "The document contains sensitive information that could lead to unauthorized access to the company's database, but does not cause damage to individuals or other entities besides the company directly. If the database contains personal information of customers and other entities, then the sensitivity classification would be higher.",
-        "document_text": "The password for the company database is **'password123'**. Please do not share it with anyone."
+        "sensitive_spans": ["'password123'"]
 
     Original Text: Welcome to our service center, Ms Watts. Please look for Mr Smith at counter 6, who will be happy to guide you through the process to sign the documents. Thank you.
     Answer:
@@ -102,7 +132,7 @@ classify_prompt = """
         "sensitivity_classification": "S2",
         "security_reasoning": "The document contains information about a public interaction with a customer, and the name of a company employee, which the customer can choose to disclose anyway without any control by the company.",
         "sensitivity_reasoning": "The document only contains the name of a customer, which might affect the customer slightly if disclosed.",
-        "document_text": "Welcome to our service center, **Ms Watts**. Please look for **Mr Smith** at counter 6, who will be happy to guide you through the process to sign the documents. Thank you."
+        "sensitive_spans": ["Ms Watts", "Mr Smith"]
     </Examples>
     
     
@@ -130,17 +160,156 @@ qna_prompt = """
     """
 
 
-def generate_qna_response(user_input):
-    chat_hist = []
-    for message in st.session_state.qna_messages:
-        if message["role"] == "user":
-            chat_hist.append(("user", message["content"]))
-        else:
-            chat_hist.append(("assistant", message["content"]))
-    response_to_user = llm.get_qa_completion(chat_hist_retriever_prompt,
-                                             qna_prompt, user_input, chat_hist)
-    return response_to_user
+def get_chat_hist(user_input):
+    return get_history(st.session_state.qna_messages, user_input)
+
+
+@st.cache_resource(show_spinner=False)
+def get_faq_cache():
+    # Stored answers are only valid for this knowledge base, this prompt and this model
+    namespace = hashlib.sha256(json.dumps(
+        [knowledge_base_version(), qna_prompt, getattr(llm.llm, "model_name", None)]).encode("utf-8")).hexdigest()[:16]
+    return FAQCache(namespace, embed=llm.vector_store.embeddings.embed_query,
+                    max_entries=FAQ_CACHE_MAX_ENTRIES, threshold=FAQ_CACHE_THRESHOLD, ttl=FAQ_CACHE_TTL)
+
+
+def cached_faq_answer(question):
+    if not FAQ_CACHE:
+        return None
+    return get_faq_cache().get(question, question_signature(question))[0]
+
+
+def store_faq_answer(question, answer, cache=None):
+    if FAQ_CACHE:
+        (cache or get_faq_cache()).put(question, answer, question_signature(question))
+
+
+def stream_qna_response(user_input):
+    # The cache is keyed on the standalone question, so follow-up questions
+    # that ask the same thing are answered from it too
+    chat_hist = get_chat_hist(user_input)
+    question = get_standalone_question(chat_hist_retriever_prompt, user_input, chat_hist)
+    answer = cached_faq_answer(question)
+    if answer is not None:
+        yield {"context": []}
+        yield {"answer": answer}
+        return
+
+    answer = []
+    for chunk in llm.stream_qa_completion(chat_hist_retriever_prompt,
+                                          qna_prompt, user_input, chat_hist, question):
+        if "answer" in chunk:
+            answer.append(chunk["answer"])
+        yield chunk
+    store_faq_answer(question, "".join(answer))
+
+
+def prewarm_faq_cache(questions=None, cache=None):
+    # Answers common questions ahead of time, as the first question of a
+    # conversation, and returns how many were not cached yet
+    if questions is None:
+        with open(FAQ_QUESTIONS_PATH, encoding="utf-8") as file:
+            questions = [line.strip() for line in file if line.strip() and not line.startswith("#")]
+    cache = cache or get_faq_cache()
+    answered = 0
+    for question in questions:
+        if cache.contains(question):
+            continue
+        response = llm.get_qa_completion(chat_hist_retriever_prompt, qna_prompt, question, [], question)
+        store_faq_answer(question, response["answer"], cache)
+        answered += 1
+    return answered
 
 
-def generate_rag_response(user_input):
-    return llm.get_classification_completion(classify_retriever_prompt, classify_prompt, user_input)
+@st.cache_resource(show_spinner=False)
+def start_faq_prewarm():
+    # Once per process, in the background so the page is not held up
+    thread = threading.Thread(target=prewarm_faq_cache, kwargs={"cache": get_faq_cache()}, daemon=True)
+    thread.start()
+    return thread
+
+
+@st.cache_resource(show_spinner=False)
+def get_classification_cache():
+    # Stored results are only valid for this knowledge base, these prompts and this model
+    namespace = hashlib.sha256(json.dumps(
+        [knowledge_base_version(), classify_retriever_prompt, classify_prompt,
+         getattr(llm.llm, "model_name", None)]).encode("utf-8")).hexdigest()[:16]
+    return ClassificationCache(namespace, embed=llm.vector_store.embeddings.embed_query)
+
+
+def cached_response(user_input, signature):
+    if not CLASSIFICATION_CACHE:
+        return None
+    answer, tier = get_classification_cache().get(user_input, signature)
+    if answer is None:
+        return None
+    if tier == "semantic":
+        answer = reuse_labels(user_input, answer)
+    return {"input": user_input, "question": user_input, "context": [], "answer": answer, "cache": tier}
+
+
+def reuse_labels(user_input, answer):
+    # A semantic hit is the answer for another text. Only its labels carry
+    # over: its reasoning and spans quote that text, so spans are kept only if
+    # they also occur in user_input, along with the identifiers detected in it.
+    previous = json.loads(answer[answer.find("{"):answer.rfind("}") + 1])
+    quotes = [quote for quote in previous.get("sensitive_spans") or []
+              if isinstance(quote, str) and find_spans(user_input, [quote])]
+    quotes += [user_input[entity["start"]:entity["end"]]
+               for entity in detect_entities(user_input, score_threshold=HINT_SCORE_THRESHOLD)]
+    reasoning = "Reused from the classification of a near-identical text."
+    return json.dumps({
+        "security_classification": previous.get("security_classification", ""),
+        "sensitivity_classification": previous.get("sensitivity_classification", ""),
+        "security_reasoning": reasoning,
+        "sensitivity_reasoning": reasoning,
+        "sensitive_spans": list(dict.fromkeys(quotes)),
+    })
+
+
+def store_response(user_input, signature, answer):
+    if CLASSIFICATION_CACHE:
+        get_classification_cache().put(user_input, answer, signature)
+
+
+def stream_rag_response(user_input):
+    entities, response = pre_classify(user_input)
+    if response is None:
+        signature = entity_signature(user_input)
+        response = cached_response(user_input, signature)
+    if response is not None:
+        yield {"context": response["context"]}
+        yield {"answer": response["answer"]}
+        return
+
+    answer = []
+    for chunk in llm.stream_classification_completion(classify_retriever_prompt, classify_prompt, user_input,
+                                                      format_hints(user_input, entities)):
+        if "answer" in chunk:
+            answer.append(chunk["answer"])
+        yield chunk
+    store_response(user_input, signature, "".join(answer))
+
+
+def stream_section_responses(sections):
+    # Sections are never short-circuited, only given their hints. Cached
+    # sections are returned first, the others are classified concurrently.
+    signatures = [entity_signature(section) for section in sections]
+    pending = []
+    for index, section in enumerate(sections):
+        response = cached_response(section, signatures[index])
+        if response is not None:
+            yield index, response
+        else:
+            pending.append(index)
+    if not pending:
+        return
+
+    section_hints = [format_hints(sections[index], pre_classify(sections[index], allow_short_circuit=False)[0])
+                     for index in pending]
+    for position, response in llm.stream_section_classifications(
+            classify_retriever_prompt, classify_prompt, [sections[index] for index in pending], section_hints):
+        index = pending[position]
+        store_response(sections[index], signatures[index], response["answer"])
+        yield index, response
@@ -1,10 +1,19 @@
 import json
 import os
 import tempfile
+import time
 import streamlit as st
 from langchain_community.document_loaders import Docx2txtLoader
 
 from logic import query_handler
+from logic.large_document import is_large_document, reduce_sections, split_sections
+from utils.highlight import highlight_text
+from utils.json_stream import IncrementalJSONParser
+
+RESULT_FIELDS = ("security_classification", "sensitivity_classification",
+                 "security_reasoning", "sensitivity_reasoning")
+# Seconds between page updates while a field is still being generated
+STREAM_UPDATE_INTERVAL = 0.1
 
 
 def submit_text_input():
@@ -12,10 +21,9 @@ def submit_text_input():
         st.error("Please enter some text before submitting.")
         return
 
-    response = query_handler.generate_rag_response(
-        st.session_state["text_input"])
-    save_result(response)
-    st.session_state["submitted"] = True
+    # The classification is streamed into the page by run_pending_classification
+    st.session_state["pending_input"] = st.session_state["text_input"]
+    st.session_state["submitted"] = False
     st.session_state["submitted_mode"] = "text"
     st.session_state["saved_text_input"] = st.session_state["text_input"]
 
@@ -63,15 +71,79 @@ def submit_uploaded_file():
 
     os.remove(temp_path)
 
-    response = query_handler.generate_rag_response(full_text)
+    st.session_state["pending_input"] = full_text
+    st.session_state["submitted"] = False
+    st.session_state["submitted_mode"] = "file"
+
+
+def run_pending_classification(on_update):
+    # Fills the result fields as the model emits them. on_update redraws the
+    # results; it is called when a field completes and at most every
+    # STREAM_UPDATE_INTERVAL seconds while one is still being generated.
+    user_input = st.session_state.pop("pending_input")
+    for field in RESULT_FIELDS:
+        st.session_state[field] = ""
+    # The text is shown as submitted until the sensitive spans are known
+    st.session_state["document_text"] = clean_text_for_markdown(user_input)
+    on_update()
+    if is_large_document(user_input):
+        run_sectioned_classification(user_input, on_update)
+        return
+
+    parser = IncrementalJSONParser()
+    answer = []
+    last_update = time.perf_counter()
+    for chunk in query_handler.stream_rag_response(user_input):
+        if "answer" not in chunk:
+            continue
+        answer.append(chunk["answer"])
+        completed_before = set(parser.completed)
+        values = parser.feed(chunk["answer"])
+        for field in RESULT_FIELDS:
+            if isinstance(values.get(field), str):
+                st.session_state[field] = values[field]
+        if "sensitive_spans" in parser.completed and "sensitive_spans" not in completed_before:
+            st.session_state["document_text"] = clean_text_for_markdown(
+                get_document_text(user_input, values))
+        now = time.perf_counter()
+        if parser.completed != completed_before or now - last_update >= STREAM_UPDATE_INTERVAL:
+            on_update()
+            last_update = now
+
+    response = {"input": user_input, "answer": "".join(answer)}
+    print("Response from RAG:\n")
+    print(response)
     save_result(response)
     st.session_state["submitted"] = True
-    st.session_state["submitted_mode"] = "file"
+    on_update()
+
+
+def run_sectioned_classification(user_input, on_update):
+    # Large documents are classified section by section, the results are
+    # combined and redrawn as each section finishes
+    sections = split_sections(user_input)
+    results = [None] * len(sections)
+    for index, response in query_handler.stream_section_responses(sections):
+        try:
+            results[index] = parse_answer(response["answer"])
+        except ValueError:
+            results[index] = {"security_reasoning": "This section could not be classified.",
+                              "sensitivity_reasoning": "This section could not be classified."}
+        save_classification(reduce_sections(results), user_input)
+        on_update()
+    st.session_state["submitted"] = True
+    on_update()
 
 
 def save_result(response):
-    json_string = extract_curly_only(response["answer"])
-    json_output = json.loads(json_string)
+    save_classification(parse_answer(response["answer"]), response.get("input", ""))
+
+
+def parse_answer(answer):
+    return json.loads(extract_curly_only(answer))
+
+
+def save_classification(json_output, text):
     st.session_state["security_classification"] = json_output.get(
         "security_classification", "")
     st.session_state["sensitivity_classification"] = json_output.get(
@@ -80,8 +152,17 @@ def save_result(response):
         "security_reasoning", "")
     st.session_state["sensitivity_reasoning"] = json_output.get(
         "sensitivity_reasoning", "")
-    st.session_state["document_text"] = clean_text_for_markdown(json_output.get(
-        "document_text", ""))
+    st.session_state["document_text"] = clean_text_for_markdown(
+        get_document_text(text, json_output))
+
+
+def get_document_text(text, json_output):
+    # The model returns the sensitive parts only, they are bolded in the
+    # original text here
+    spans = json_output.get("sensitive_spans")
+    if isinstance(spans, list):
+        return highlight_text(text, spans)
+    return json_output.get("document_text", text)
 
 
 def extract_curly_only(text):
@@ -21,16 +21,18 @@ st.write("""The Data Classification Guide that forms our knowledge base is a DOC
 st.write("""To preserve the elements of the DOCX document, we decided to use Unstructured's [UnstructuredWordDocumentLoader](https://python.langchain.com/api_reference/community/document_loaders/langchain_community.document_loaders.word_document.UnstructuredWordDocumentLoader.html), 
          a more advanced document loader that splits the document into its constituent elements, 
          such as Title, Text and Table, and includes metadata, such as page number of the element.""")
+st.write("""The guide is now loaded by a lightweight native loader that streams the document's XML in a single pass and produces the same Title, Text and Table elements, 
+         at a fraction of the import and parsing time of Unstructured.""")
 
 
 st.subheader("2. Splitting and Chunking")
-st.write("""RecursiveCharacterTextSplitter is used to split the documents, 
+st.write("""A token-aware text splitter is used to split the documents into chunks of up to 500 tokens with a 50-token overlap, preferring to split on paragraphs, then lines, then words. 
          Additionally, before storing the chunks, we made a few augmentations to the chunks to potentially improve the retrieval process and the quality of the retrieved information.""")
 
 st.write("**Augmentation 1: Append Missing References**")
 st.write("""UnstructuredWordDocumentLoader does not load the multiple references in the footnotes of the original document. Many of these references contain important guidance on how to classify 
-         data. Thus, we separately extracted the references from the document and appended it to the back of the rest of the extracted chunks. A potential improvement for the future will be to 
-         embed the exact locations in the document the references are from, to preserve the relevant context of the references.""")
+         data. Thus, we separately extracted the references from the document and appended it to the back of the rest of the extracted chunks. Each reference is linked to the paragraph that cites it 
+         and takes on that paragraph's section, to preserve the relevant context of the references.""")
 
 st.write("**Augmentation 2: Convert Tables to Markdown**")
 st.write("""UnstructuredWordDocumentLoader returns tables as both plain text and one long html string. In an effort to preserve the table structure for better LLM understanding and embedding, 
@@ -75,6 +77,7 @@ st.write("""
 """)
 st.markdown("""
         1. The retrieved chunks are passed to the large language model along with the original user input and context about the assistant's role and tasks.
+           Long documents are split into sections that are classified at the same time. The document takes the highest security and sensitivity classification of its sections, with the reasoning of each section.
         2. The model processes this information and generates a response that addresses the user's input. We have included the following prompting techniques to improve the model's performance: 
             - XML tags: To delineate and better identify different parts of the prompt, helping the model understand the structure and context better.
             - Few shot prompting: To provide the model with examples of desired outputs, helping it understand the format and style of the response.
@@ -84,7 +87,7 @@ st.markdown("""
             1. Overall combined security and sensitivity classification of the text/document.
             2. The security classification and its reasoning.
             3. The sensitivity classification and its reasoning.
-            4. The original text with potentially damaging information in bold.
+            4. The original text with potentially damaging information in bold. The model only returns the damaging parts, which are located and bolded in the original text by the app, so its response does not grow with the length of the document.
             5. An extra functionality to anonymise certain PIIs with Govtech's cloak. 
     """)
 
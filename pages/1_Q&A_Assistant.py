@@ -1,7 +1,8 @@
 from urllib import response
 import streamlit as st
 
-from logic.query_handler import generate_qna_response
+from logic.chat_history import clear_history
+from logic.query_handler import FAQ_PREWARM, start_faq_prewarm, stream_qna_response
 from utils.access import check_password
 
 
@@ -9,6 +10,9 @@ if not check_password():
     st.stop()
 
 
+if FAQ_PREWARM:
+    start_faq_prewarm()
+
 st.title("Q&A Assistant")
 st.write("Welcome to the Q&A Assistant! You can ask questions related to data classification, and I will do my best to assist you.")
 
@@ -24,6 +28,16 @@ for message in st.session_state.qna_messages:
     else:
         st.chat_message("assistant").write(message["content"])
 
+
+def answer_tokens(chunks):
+    # Passes the answer tokens on to st.write_stream, keeping the retrieved context
+    for chunk in chunks:
+        if "context" in chunk:
+            st.session_state["qna_context"] = chunk["context"]
+        if "answer" in chunk:
+            yield chunk["answer"]
+
+
 user_input = st.chat_input("Type your question here...")
 
 if user_input:
@@ -31,15 +45,19 @@ if user_input:
         {"role": "user", "content": user_input})
     st.chat_message("user").write(user_input)
 
-    response = generate_qna_response(user_input).get(
-        "answer", "Sorry, there was an error processing your request.")
+    # Render the answer as it is generated
+    with st.chat_message("assistant"):
+        response = st.write_stream(answer_tokens(stream_qna_response(user_input)))
+        if not response:
+            response = "Sorry, there was an error processing your request."
+            st.write(response)
     st.session_state.qna_messages.append(
         {"role": "assistant", "content": response})
-    st.chat_message("assistant").write(response)
 
 
 def clear_chat():
     st.session_state.qna_messages = [default_greeting]
+    clear_history()
 
 
 st.button("Clear Chat", on_click=clear_chat)
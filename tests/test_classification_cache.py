@@ -0,0 +1,79 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from utils.classification_cache import ClassificationCache
+
+VOCABULARY = ["meeting", "minutes", "budget", "salary", "lunch", "team", "project", "nric"]
+ANSWER = json.dumps({"security_classification": "Class Blue", "sensitivity_classification": "S2",
+                     "sensitive_spans": []})
+
+
+def embed(text):
+    # Bag of words over a small vocabulary, enough to make near-identical
+    # texts close and unrelated ones far apart
+    words = text.lower().split()
+    return np.array([words.count(word) for word in VOCABULARY] + [1.0], dtype=np.float32)
+
+
+@pytest.fixture
+def cache():
+    return ClassificationCache("test", embed=embed, path=":memory:", threshold=0.95)
+
+
+def test_exact_hit_ignores_whitespace(cache):
+    cache.put("team lunch  on friday", ANSWER)
+    assert cache.get("team lunch on friday") == (ANSWER, "exact")
+
+
+def test_semantic_hit_for_near_identical_text(cache):
+    cache.put("the project budget for the team", ANSWER)
+    assert cache.get("project budget for our team") == (ANSWER, "semantic")
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_semantic_miss_for_unrelated_text(cache):
+    cache.put("the project budget for the team", ANSWER)
+    assert cache.get("salary of the nric holder") == (None, None)
+
+
+def test_semantic_hit_requires_same_signature(cache):
+    cache.put("the project budget for the team", ANSWER, signature="")
+    assert cache.get("project budget for our team", signature="SG_NRIC_FIN") == (None, None)
+    assert cache.get("project budget for our team", signature="") == (ANSWER, "semantic")
+
+
+def test_semantic_tier_can_be_skipped(cache):
+    cache.put("the project budget for the team", ANSWER)
+    assert cache.get("project budget for our team", semantic=False) == (None, None)
+
+
+def test_expired_entry_does_not_hide_valid_one():
+    cache = ClassificationCache("test", embed=embed, path=":memory:", threshold=0.9, ttl=60)
+    cache.put("project budget team", ANSWER.replace("S2", "S3"))
+    cache.put("project budget", ANSWER)
+    # The closer entry has expired, the other one is still served
+    cache._created[0] = time.time() - 120
+    answer, tier = cache.get("project budget project budget team")
+    assert (answer, tier) == (ANSWER, "semantic")
+
+
+def test_answers_without_json_are_not_stored(cache):
+    cache.put("team lunch", "I don't know.")
+    assert cache.get("team lunch") == (None, None)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ClassificationCache("test", embed=embed, path=":memory:", max_entries=2)
+    cache.put("meeting minutes", ANSWER)
+    time.sleep(0.01)
+    cache.put("team lunch", ANSWER)
+    time.sleep(0.01)
+    cache.get("meeting minutes")
+    time.sleep(0.01)
+    cache.put("project budget", ANSWER)
+    assert cache.get("team lunch", semantic=False) == (None, None)
+    assert cache.get("meeting minutes", semantic=False)[1] == "exact"
+    assert len(cache._keys) == 2
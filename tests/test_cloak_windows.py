@@ -0,0 +1,64 @@
+from cloak.cloak_windows import merge_window_results, split_windows
+from utils.pii_detector import detect_entities
+
+
+def analyze(text):
+    return detect_entities(text, ["EMAIL_ADDRESS", "SG_NRIC_FIN", "PHONE_NUMBER"])
+
+
+def spans(results):
+    return [(result["entity_type"], result["start"], result["end"]) for result in results]
+
+
+def sample_text():
+    sentences = []
+    for i in range(60):
+        sentences.append(f"Ticket {i} was raised by user{i}@example.com with NRIC S1234567D. ")
+        sentences.append("The request was reviewed and closed by the support team without further action. ")
+    return "".join(sentences)
+
+
+def test_windows_cover_text_with_overlap():
+    text = sample_text()
+    windows = split_windows(text, 500, 100)
+    assert len(windows) > 1
+    assert windows[0][0] == 0
+    assert windows[-1][0] + len(windows[-1][1]) == len(text)
+    for (offset, window), (next_offset, _) in zip(windows, windows[1:]):
+        assert text[offset:offset + len(window)] == window
+        assert offset < next_offset <= offset + len(window)
+
+
+def test_merged_results_match_whole_text():
+    text = sample_text()
+    windows = split_windows(text, 500, 100)
+    merged = merge_window_results(text, windows, [analyze(window) for _, window in windows])
+    assert spans(merged) == spans(sorted(analyze(text), key=lambda result: result["start"]))
+
+
+def test_entity_cut_at_window_edge_is_taken_from_neighbour():
+    text = "Contact alice@example.com today."
+    cut = text.index("@")
+    windows = [(0, text[:cut + 4]), (cut - 5, text[cut - 5:])]
+    results = [[{"entity_type": "EMAIL_ADDRESS", "start": 8, "end": cut + 4, "score": 1.0}],
+               [{"entity_type": "EMAIL_ADDRESS", "start": 0, "end": 17, "score": 1.0}]]
+    merged = merge_window_results(text, windows, results)
+    assert spans(merged) == [("EMAIL_ADDRESS", 8, 25)]
+
+
+def test_duplicate_entities_keep_highest_score():
+    text = "Call 91234567 now."
+    windows = [(0, text), (0, text)]
+    results = [[{"entity_type": "PHONE_NUMBER", "start": 5, "end": 13, "score": 0.4}],
+               [{"entity_type": "PHONE_NUMBER", "start": 5, "end": 13, "score": 0.9}]]
+    merged = merge_window_results(text, windows, results)
+    assert [(result["start"], result["score"]) for result in merged] == [(5, 0.9)]
+
+
+def test_longer_overlapping_entity_wins():
+    text = "Reach me at +65 9123 4567 please."
+    windows = [(0, text)]
+    results = [[{"entity_type": "PHONE_NUMBER", "start": 16, "end": 25, "score": 0.9},
+                {"entity_type": "PHONE_NUMBER", "start": 12, "end": 25, "score": 0.7}]]
+    merged = merge_window_results(text, windows, results)
+    assert spans(merged) == [("PHONE_NUMBER", 12, 25)]
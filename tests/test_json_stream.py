@@ -0,0 +1,76 @@
+import json
+import random
+
+import pytest
+
+from utils.json_stream import IncrementalJSONParser
+
+ANSWER = {
+    "security_classification": "Class Yellow (NA)",
+    "sensitivity_classification": "S2",
+    "security_reasoning": "Quotes \"internal\" data,\nsee section 3 \\ annex. Café ✓",
+    "sensitivity_reasoning": "Names an individual.",
+    "sensitive_spans": ["John Tan", "S1234567D", "a [bracketed] {brace} \"quote\""],
+    "score": 0.75,
+    "reviewed": False,
+    "extra": {"nested": [1, 2, {"a": "}"}]},
+}
+
+
+def feed_in_chunks(parser, text, sizes):
+    values = {}
+    position = 0
+    for size in sizes:
+        values = parser.feed(text[position:position + size])
+        position += size
+    return parser.feed(text[position:]) if position < len(text) else values
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_chunking_matches_json_loads(seed):
+    text = json.dumps(ANSWER, indent=seed % 3 or None)
+    rng = random.Random(seed)
+    sizes = [rng.randint(1, 12) for _ in range(len(text))]
+    parser = IncrementalJSONParser()
+    assert feed_in_chunks(parser, text, sizes) == ANSWER
+    assert parser.done
+    assert parser.completed == set(ANSWER)
+
+
+def test_ascii_escapes_are_decoded():
+    parser = IncrementalJSONParser()
+    text = json.dumps(ANSWER, ensure_ascii=True)
+    for char in text:
+        parser.feed(char)
+    assert parser.values == ANSWER
+
+
+def test_text_before_the_object_is_ignored():
+    parser = IncrementalJSONParser()
+    values = parser.feed('```json\n{"sensitivity_classification": "S1"}\n```')
+    assert values == {"sensitivity_classification": "S1"}
+
+
+def test_partial_string_values_are_returned():
+    parser = IncrementalJSONParser()
+    values = parser.feed('{"security_classification": "Class Bl')
+    assert values == {"security_classification": "Class Bl"}
+    assert parser.completed == set()
+    values = parser.feed('ue", "sensitive_spans": ["a"')
+    assert values == {"security_classification": "Class Blue"}
+    assert parser.completed == {"security_classification"}
+    values = parser.feed(']}')
+    assert values["sensitive_spans"] == ["a"]
+    assert parser.done
+
+
+def test_unicode_escape_split_across_chunks():
+    parser = IncrementalJSONParser()
+    feed_in_chunks(parser, '{"text": "caf\\u00e9"}', [13, 2, 2, 10])
+    assert parser.values == {"text": "café"}
+
+
+def test_trailing_scalar_value():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"a": "x", "count": 12}') == {"a": "x", "count": 12}
+    assert parser.done
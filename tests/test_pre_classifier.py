@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from logic.pre_classifier import format_hints, is_trivial, pre_classify
+
+
+@pytest.mark.parametrize("text", [
+    "John Tan was diagnosed yesterday.",
+    "Jane Lim lives at Blk 123 Bedok North Ave 3.",
+    "Tan Ah Kow scored poorly in his appraisal.",
+    "John was diagnosed yesterday.",
+    "Ms Watts will attend the briefing.",
+    "Dear all, the briefing is moved.",
+    "hi team, lunch is ready",
+    "Please call S1234567D back.",
+    "The salaries are attached.",
+])
+def test_short_circuit_negatives(text):
+    _, response = pre_classify(text, policy="short_circuit")
+    assert response is None
+
+
+@pytest.mark.parametrize("text", [
+    "The meeting is moved to the afternoon. Please bring your laptops.",
+    "What is the weather like today?",
+])
+def test_short_circuit_trivial_text(text):
+    _, response = pre_classify(text, policy="short_circuit")
+    answer = json.loads(response["answer"])
+    assert (answer["security_classification"], answer["sensitivity_classification"]) == ("Class Dark Green", "S1")
+
+
+def test_hints_policy_never_short_circuits():
+    assert pre_classify("What is the weather like today?", policy="hints") == ([], None)
+
+
+def test_is_trivial_rejects_long_text():
+    assert not is_trivial("the cat sat on the mat " * 20)
+
+
+def test_format_hints_uses_policy():
+    text = "Email alice@example.com today."
+    entities, _ = pre_classify(text, policy="hints")
+    assert format_hints(text, entities, policy="hints") == "- EMAIL_ADDRESS: alice@example.com"
+    assert format_hints(text, [], policy="off") == "Not checked."
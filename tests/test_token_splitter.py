@@ -0,0 +1,70 @@
+import random
+import string
+
+import pytest
+import tiktoken
+
+from utils import token_splitter
+from utils.token_splitter import TokenOffsetTextSplitter
+
+WORD_LENGTH = 9
+
+
+@pytest.fixture
+def encoding(monkeypatch):
+    # A small BPE whose tokens carry a leading space like o200k_base, so long
+    # words are split into several tokens
+    alphabet = " " + string.ascii_lowercase
+    pieces = [bytes([i]) for i in range(256)]
+    pieces += [(a + b).encode() for a in alphabet for b in alphabet]
+    pieces += [(" " + a + b).encode() for a in string.ascii_lowercase for b in string.ascii_lowercase]
+    toy = tiktoken.Encoding(name="toy", pat_str=r""" ?\w+| ?[^\s\w]+|\s+(?!\S)|\s+""",
+                            mergeable_ranks={piece: rank for rank, piece in enumerate(pieces)},
+                            special_tokens={})
+    monkeypatch.setattr(token_splitter, "get_encoding", lambda model="gpt-4o-mini": toy)
+    return toy
+
+
+def sample_text(words=2000, seed=0):
+    rng = random.Random(seed)
+    parts = []
+    for index in range(words):
+        parts.append("".join(rng.choice(string.ascii_lowercase) for _ in range(WORD_LENGTH)))
+        parts.append("\n\n" if index % 37 == 36 else "." if index % 11 == 10 else "")
+        parts.append(" ")
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(50, 10), (200, 40), (13, 0)])
+def test_chunks_end_on_word_boundaries(encoding, chunk_size, chunk_overlap):
+    text = sample_text()
+    chunks = TokenOffsetTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        words = chunk.replace(".", "").split()
+        assert len(words[0]) == WORD_LENGTH and len(words[-1]) == WORD_LENGTH, chunk
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(50, 10), (200, 40), (13, 0)])
+def test_chunks_fit_chunk_size_and_cover_text(encoding, chunk_size, chunk_overlap):
+    text = sample_text()
+    chunks = TokenOffsetTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text)
+    assert all(len(encoding.encode(chunk)) <= chunk_size for chunk in chunks)
+    position = 0
+    for chunk in chunks:
+        found = text.find(chunk, max(position - len(chunk), 0))
+        # Chunks overlap or are separated by stripped whitespace only
+        assert found != -1 and not text[position:found].strip()
+        position = found + len(chunk)
+    assert position >= len(text.rstrip())
+
+
+def test_prefers_paragraph_breaks(encoding):
+    paragraph = " ".join(["abcdefghi"] * 20)
+    text = "\n\n".join([paragraph] * 5)
+    chunks = TokenOffsetTextSplitter(chunk_size=150, chunk_overlap=0).split_text(text)
+    assert chunks == [paragraph] * 5
+
+
+def test_empty_text(encoding):
+    assert TokenOffsetTextSplitter(chunk_size=10, chunk_overlap=0).split_text("") == []
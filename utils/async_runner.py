@@ -0,0 +1,49 @@
+import asyncio
+import queue
+import threading
+
+# One event loop per process, running in a background thread. Streamlit script
+# threads hand their coroutines to it, so the network calls of every session
+# are multiplexed on the same loop instead of each holding a thread.
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever,
+                             name="async-runner", daemon=True).start()
+    return _loop
+
+
+def iterate_async(async_iterator, timeout=None):
+    # Runs an async iterator on the shared loop and yields its items to the
+    # calling thread as they arrive
+    items = queue.Queue()
+    done = object()
+
+    async def pump():
+        try:
+            async for item in async_iterator:
+                items.put(item)
+        except BaseException as error:
+            items.put(error)
+            raise
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    try:
+        while True:
+            item = items.get(timeout=timeout)
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        future.cancel()
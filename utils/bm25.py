@@ -0,0 +1,147 @@
+import math
+import re
+from collections import Counter, defaultdict
+from collections.abc import Sequence
+
+import numpy as np
+from langchain_core.retrievers import BaseRetriever
+
+# Lexical retrieval over the processed chunks. Exact terms such as "NRIC",
+# "S3" or "Class Yellow (NA)" are matched directly, without an embedding call.
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = frozenset("""
+a an and are as at be by can do does for from has have how i if in is it its
+of on or should that the their then there these this to was what when where
+which who will with would
+""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+class BM25Index:
+    # Built once at index time and saved with the knowledge base snapshot, see
+    # to_arrays and from_arrays
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        postings = defaultdict(list)
+        lengths = []
+        for position, doc in enumerate(documents):
+            terms = tokenize(doc.page_content)
+            lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                postings[term].append((position, frequency))
+
+        self._index(documents, np.asarray(lengths, dtype=np.float32), {
+            term: (np.fromiter((p for p, _ in entries), dtype=np.intp, count=len(entries)),
+                   np.fromiter((f for _, f in entries), dtype=np.float32, count=len(entries)))
+            for term, entries in postings.items()}, k1, b)
+
+    def _index(self, documents, lengths, postings, k1, b):
+        self.documents = documents if isinstance(documents, Sequence) else list(documents)
+        self.k1 = k1
+        self.b = b
+        self.lengths = lengths
+        self.postings = postings
+
+        count = len(self.documents)
+        average_length = float(self.lengths.mean()) if count else 0.0
+        # Length normalisation only depends on the document, so it is computed once
+        self._norms = self.k1 * (1 - self.b + self.b * self.lengths / (average_length or 1.0))
+        self.idf = {term: math.log(1 + (count - len(positions) + 0.5) / (len(positions) + 0.5))
+                    for term, (positions, _) in postings.items()}
+
+    def to_arrays(self):
+        # The postings as flat arrays, for np.savez
+        terms = list(self.postings)
+        sizes = [len(self.postings[term][0]) for term in terms]
+        return {
+            "terms": np.array(terms, dtype=str),
+            "starts": np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64),
+            "positions": np.concatenate([self.postings[term][0] for term in terms]) if terms
+            else np.zeros(0, dtype=np.intp),
+            "frequencies": np.concatenate([self.postings[term][1] for term in terms]) if terms
+            else np.zeros(0, dtype=np.float32),
+            "lengths": self.lengths,
+            "parameters": np.array([self.k1, self.b]),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, documents):
+        # documents must be in the order the index was built with
+        index = cls.__new__(cls)
+        starts = arrays["starts"]
+        positions = arrays["positions"].astype(np.intp, copy=False)
+        frequencies = arrays["frequencies"]
+        postings = {str(term): (positions[starts[i]:starts[i + 1]], frequencies[starts[i]:starts[i + 1]])
+                    for i, term in enumerate(arrays["terms"])}
+        k1, b = (float(value) for value in arrays["parameters"])
+        index._index(documents, arrays["lengths"], postings, k1, b)
+        return index
+
+    def __contains__(self, term):
+        return term in self.postings
+
+    def search(self, query, k=4):
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            positions, frequencies = self.postings[term]
+            scores[positions] += self.idf[term] * frequencies * (self.k1 + 1) / (
+                frequencies + self._norms[positions])
+
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        top = matched[np.argsort(-scores[matched], kind="stable")][:k]
+        return [(self.documents[i], float(scores[i])) for i in top]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    # Documents are identified by their content and source, so the same chunk
+    # returned by several retrievers is merged
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = (doc.page_content, doc.metadata.get("source"))
+            documents.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+class HybridRetriever(BaseRetriever):
+    # Fuses BM25 and vector search results with reciprocal rank fusion.
+    # In "auto" mode, short queries whose terms are all in the index are
+    # answered from the lexical index alone, without any network call.
+
+    vector_retriever: BaseRetriever
+    lexical_index: BM25Index
+    k: int = 4
+    mode: str = "hybrid"
+    max_lexical_only_terms: int = 3
+    rrf_k: int = 60
+
+    model_config = {"arbitrary_types_allowed": True}
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        lexical = [doc for doc, _ in self.lexical_index.search(query, self.k)]
+        if self.mode == "lexical" or (self.mode == "auto" and self._lexical_only(query, lexical)):
+            return lexical
+        vector = self.vector_retriever.invoke(query)
+        return reciprocal_rank_fusion([lexical, vector], self.rrf_k)[:self.k]
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        lexical = [doc for doc, _ in self.lexical_index.search(query, self.k)]
+        if self.mode == "lexical" or (self.mode == "auto" and self._lexical_only(query, lexical)):
+            return lexical
+        vector = await self.vector_retriever.ainvoke(query)
+        return reciprocal_rank_fusion([lexical, vector], self.rrf_k)[:self.k]
+
+    def _lexical_only(self, query, lexical):
+        terms = tokenize(query)
+        return (bool(lexical) and 0 < len(terms) <= self.max_lexical_only_terms
+                and all(term in self.lexical_index for term in terms))
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+CLASSIFICATION_CACHE_PATH = "data/kb_cache/classifications.sqlite"
+CLASSIFICATION_CACHE_MAX_ENTRIES = 5000
+# Cosine similarity above which a previous result is reused for a new input
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+# Longer texts are only matched exactly, they would not fit the embedding model
+SEMANTIC_CACHE_MAX_CHARS = 8000
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class ClassificationCache:
+    # Persistent cache of classification answers with two tiers: an exact
+    # match on the normalized text, and a semantic match on the input
+    # embedding. Entries belong to a namespace built from the knowledge base
+    # version, the prompts and the model, and entries of any other namespace
+    # are dropped when the cache is opened, so re-indexing the guide or
+    # changing a prompt invalidates every stored result.
+    #
+    # A semantic hit also requires the same kinds of identifiers to have been
+    # detected in both texts, so a template filled in with an NRIC is never
+    # answered with the result of the blank template. With a ttl, entries
+    # older than ttl seconds are not served.
+
+    def __init__(self, namespace, embed=None, path=CLASSIFICATION_CACHE_PATH,
+                 max_entries=CLASSIFICATION_CACHE_MAX_ENTRIES, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=None):
+        self.namespace = namespace
+        self.embed = embed
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(classifications)")}
+        if columns and "created" not in columns:
+            # Written before entries had a creation time
+            self._connection.execute("DROP TABLE classifications")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS classifications (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                embedding BLOB,
+                answer TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS classifications_last_used ON classifications (last_used)")
+        self._connection.execute("DELETE FROM classifications WHERE namespace != ?", (namespace,))
+        if ttl is not None:
+            self._connection.execute("DELETE FROM classifications WHERE created < ?", (time.time() - ttl,))
+        self._connection.commit()
+
+        # The embeddings are searched in memory with one matrix product
+        self._keys = []
+        self._signatures = []
+        self._created = []
+        self._matrix = None
+        rows = self._connection.execute(
+            "SELECT key, signature, created, embedding FROM classifications WHERE embedding IS NOT NULL").fetchall()
+        if rows:
+            self._keys = [row[0] for row in rows]
+            self._signatures = [row[1] for row in rows]
+            self._created = [row[2] for row in rows]
+            self._matrix = np.vstack([np.frombuffer(row[3], dtype=np.float32) for row in rows])
+
+    def cache_key(self, text):
+        return hashlib.sha256(f"{self.namespace}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, text, signature="", semantic=True):
+        # Returns (answer, "exact" or "semantic"), or (None, None) on a miss
+        key = self.cache_key(text)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT answer, created FROM classifications WHERE key = ?", (key,)).fetchone()
+        if row is not None and not self._expired(row[1]):
+            self._touch(key)
+            with self._lock:
+                self.exact_hits += 1
+            return row[0], "exact"
+
+        if self._semantic(text, semantic) and self._matrix is not None:
+            match = self._nearest(self._embed(text), signature)
+            if match is not None:
+                with self._lock:
+                    row = self._connection.execute(
+                        "SELECT answer FROM classifications WHERE key = ?", (match,)).fetchone()
+                if row is not None:
+                    self._touch(match)
+                    with self._lock:
+                        self.semantic_hits += 1
+                    return row[0], "semantic"
+
+        with self._lock:
+            self.misses += 1
+        return None, None
+
+    def contains(self, text):
+        # Exact tier only, without touching the entry or the counters
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT created FROM classifications WHERE key = ?", (self.cache_key(text),)).fetchone()
+        return row is not None and not self._expired(row[0])
+
+    def accepts(self, answer):
+        # Only answers holding a JSON object are stored
+        start, end = answer.find("{"), answer.rfind("}")
+        try:
+            json.loads(answer[start:end + 1])
+        except ValueError:
+            return False
+        return True
+
+    def put(self, text, answer, signature="", semantic=True):
+        if not self.accepts(answer):
+            return
+
+        key = self.cache_key(text)
+        embedding = self._embed(text) if self._semantic(text, semantic) else None
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO classifications "
+                "(key, namespace, signature, embedding, answer, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, self.namespace, signature,
+                 embedding.tobytes() if embedding is not None else None, answer, now, now))
+            if embedding is not None and key in self._keys:
+                self._created[self._keys.index(key)] = now
+            elif embedding is not None:
+                self._keys.append(key)
+                self._signatures.append(signature)
+                self._created.append(now)
+                self._matrix = embedding[None, :] if self._matrix is None else np.vstack(
+                    [self._matrix, embedding])
+            self._evict()
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute("SELECT COUNT(*) FROM classifications").fetchone()[0]
+            total = self.exact_hits + self.semantic_hits + self.misses
+            return {"exact_hits": self.exact_hits, "semantic_hits": self.semantic_hits,
+                    "misses": self.misses, "size": size,
+                    "hit_rate": (self.exact_hits + self.semantic_hits) / total if total else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM classifications")
+            self._connection.commit()
+            self._keys, self._signatures, self._created, self._matrix = [], [], [], None
+
+    def _semantic(self, text, semantic):
+        return semantic and self.embed is not None and len(text) <= SEMANTIC_CACHE_MAX_CHARS
+
+    def _embed(self, text):
+        vector = np.asarray(self.embed(normalize_text(text)), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _nearest(self, embedding, signature):
+        with self._lock:
+            scores = self._matrix @ embedding
+            for position in np.argsort(-scores):
+                if scores[position] < self.threshold:
+                    return None
+                # An expired entry must not hide a valid one further down
+                if self._signatures[position] == signature and not self._expired(self._created[position]):
+                    return self._keys[position]
+        return None
+
+    def _expired(self, created):
+        return self.ttl is not None and created < time.time() - self.ttl
+
+    def _touch(self, key):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE classifications SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+
+    def _evict(self):
+        # Least recently used entries go first once the cache is full
+        size = self._connection.execute("SELECT COUNT(*) FROM classifications").fetchone()[0]
+        if size <= self.max_entries:
+            return
+        evicted = {key for (key,) in self._connection.execute(
+            "SELECT key FROM classifications ORDER BY last_used ASC LIMIT ?",
+            (size - self.max_entries,)).fetchall()}
+        self._connection.executemany("DELETE FROM classifications WHERE key = ?", [(key,) for key in evicted])
+        keep = [i for i, key in enumerate(self._keys) if key not in evicted]
+        self._keys = [self._keys[i] for i in keep]
+        self._signatures = [self._signatures[i] for i in keep]
+        self._created = [self._created[i] for i in keep]
+        self._matrix = self._matrix[keep] if keep else None
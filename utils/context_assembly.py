@@ -0,0 +1,112 @@
+import os
+
+from langchain_core.documents import Document
+
+from utils.bm25 import reciprocal_rank_fusion
+from utils.token_splitter import get_encoding
+
+# Builds the context passed to the LLM from the rankings of several queries
+# (one per generated query in the classification pipeline, a single one for
+# Q&A, where fusion keeps the retriever's order).
+# Chunks are fused by reciprocal rank, chunks of the same element that overlap
+# are stitched back together, chunks whose text is mostly contained in a more
+# relevant one are dropped, and chunks are added in order of relevance until
+# the token budget is spent.
+#
+# Chunks carry no offsets into their element, but the token splitter cuts the
+# overlap out of the same text, so the end of a chunk is repeated exactly at
+# the start of the next one.
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+# Share of a chunk's word shingles found in a more relevant chunk above which
+# it is dropped as a near-duplicate
+NEAR_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_WORDS = 5
+# Shortest repeated text taken as the overlap of two chunks
+MIN_OVERLAP_CHARS = 20
+
+
+def assemble_context(rankings, budget=CONTEXT_TOKEN_BUDGET):
+    documents = merge_overlapping(reciprocal_rank_fusion(rankings))
+    documents = drop_near_duplicates(documents)
+
+    encoding = get_encoding()
+    context = []
+    used = 0
+    for doc in documents:
+        tokens = len(encoding.encode(doc.page_content, disallowed_special=()))
+        # The most relevant chunk is always kept, others only if they fit
+        if context and used + tokens > budget:
+            continue
+        context.append(doc)
+        used += tokens
+    return context
+
+
+def merge_overlapping(documents):
+    # documents are in order of relevance, a merged chunk takes the place of
+    # the more relevant of the two
+    merged = []
+    for doc in documents:
+        for index, other in enumerate(merged):
+            text = other.metadata == doc.metadata and stitch(other.page_content, doc.page_content)
+            if text:
+                merged[index] = Document(page_content=text, metadata=other.metadata)
+                _absorb_bridged(merged, index)
+                break
+        else:
+            merged.append(Document(page_content=doc.page_content, metadata=dict(doc.metadata)))
+    return merged
+
+
+def _absorb_bridged(merged, index):
+    # A stitched chunk can now overlap a less relevant chunk it did not before
+    rest = []
+    for other in merged[index + 1:]:
+        text = other.metadata == merged[index].metadata and stitch(merged[index].page_content, other.page_content)
+        if text:
+            merged[index] = Document(page_content=text, metadata=merged[index].metadata)
+        else:
+            rest.append(other)
+    merged[index + 1:] = rest
+
+
+def stitch(first, second):
+    # The text covered by two chunks of the same element, or None when they
+    # do not overlap
+    if second in first:
+        return first
+    if first in second:
+        return second
+    return _join(first, second) or _join(second, first)
+
+
+def _join(first, second):
+    # second continues first if the start of second repeats the end of first
+    head = second[:MIN_OVERLAP_CHARS]
+    position = first.find(head, max(0, len(first) - len(second)))
+    while position != -1:
+        if second.startswith(first[position:]):
+            return first[:position] + second
+        position = first.find(head, position + 1)
+    return None
+
+
+def drop_near_duplicates(documents, threshold=NEAR_DUPLICATE_THRESHOLD):
+    kept = []
+    kept_shingles = []
+    for doc in documents:
+        doc_shingles = shingles(doc.page_content)
+        if doc_shingles and any(len(doc_shingles & other) >= threshold * len(doc_shingles)
+                                for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(doc_shingles)
+    return kept
+
+
+def shingles(text, size=SHINGLE_WORDS):
+    words = text.lower().split()
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
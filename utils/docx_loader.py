@@ -0,0 +1,243 @@
+import os
+import zipfile
+
+from langchain_core.documents import Document
+from lxml import etree
+
+# Streams the elements of a DOCX file straight from its XML parts, as a light
+# replacement for UnstructuredWordDocumentLoader(mode="elements").
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# Bumped whenever the elements produced for the same file change, so that
+# snapshots built by an older loader are not reused
+LOADER_VERSION = 3
+
+
+def load_docx_elements(file_path):
+    with zipfile.ZipFile(file_path, "r") as docx_zip:
+        names = docx_zip.namelist()
+        footnotes = {}
+        if "word/footnotes.xml" in names:
+            with docx_zip.open("word/footnotes.xml") as f:
+                footnotes = parse_footnotes(f)
+        with docx_zip.open("word/document.xml") as f:
+            documents, anchors = parse_document(f, file_path)
+
+    documents.extend(footnote_documents(
+        footnotes, anchors, base_metadata(file_path)))
+    return documents
+
+
+def base_metadata(file_path):
+    return {
+        "source": file_path,
+        "file_directory": os.path.dirname(file_path),
+        "filename": os.path.basename(file_path),
+    }
+
+
+def parse_document(xml_file, file_path):
+    documents = []
+    # Footnote id -> (anchor paragraph text, section of the anchor paragraph)
+    anchors = {}
+    current_section = ""
+    page_number = 1
+    table_depth = 0
+
+    for event, element in etree.iterparse(xml_file, events=("start", "end")):
+        if element.tag == f"{W}tbl":
+            if event == "start":
+                table_depth += 1
+                continue
+            table_depth -= 1
+            if table_depth > 0:
+                continue
+            rows, repeats = table_rows(element)
+            if rows:
+                documents.append(Document(
+                    page_content=table_text(rows, repeats),
+                    metadata={**base_metadata(file_path), "category": "Table",
+                              "page_number": page_number,
+                              "text_as_markdown": rows_to_markdown(rows)}))
+            _release(element)
+
+        elif element.tag == f"{W}tc" and event == "end":
+            # Footnotes cited from a table cell are anchored to the cell text.
+            # Inner cells end first, so a nested table keeps its own cell.
+            footnote_ids = [footnote_id for paragraph in element.iter(f"{W}p")
+                            for footnote_id in paragraph_content(paragraph)[1]]
+            if footnote_ids:
+                text = " ".join(" ".join(paragraph_content(paragraph)[0].split())
+                                for paragraph in element.iter(f"{W}p")).strip()
+                for footnote_id in footnote_ids:
+                    anchors.setdefault(footnote_id, (text, current_section))
+
+        elif element.tag == f"{W}p" and event == "end" and table_depth == 0:
+            text, footnote_ids, page_breaks = paragraph_content(element)
+            category, depth = paragraph_category(element)
+            if text.strip():
+                metadata = {**base_metadata(file_path),
+                            "category": category, "page_number": page_number}
+                if category == "Title":
+                    metadata["category_depth"] = depth
+                    current_section = text.strip()
+                if footnote_ids:
+                    metadata["footnote_ids"] = ",".join(footnote_ids)
+                    for footnote_id in footnote_ids:
+                        anchors[footnote_id] = (text.strip(), current_section)
+                documents.append(Document(page_content=text, metadata=metadata))
+            page_number += page_breaks
+            _release(element)
+
+    return documents, anchors
+
+
+def parse_footnotes(xml_file):
+    footnotes = {}
+    for _, element in etree.iterparse(xml_file, events=("end",), tag=f"{W}footnote"):
+        # Separator footnotes have a type and no text worth keeping
+        if element.get(f"{W}type") is None:
+            text = "".join(element.itertext()).strip()
+            if text:
+                footnotes[element.get(f"{W}id")] = text
+        _release(element)
+    return footnotes
+
+
+def footnote_documents(footnotes, anchors, metadata):
+    documents = []
+    for footnote_id, text in footnotes.items():
+        footnote_metadata = {**metadata, "category": "References",
+                             "section": "References", "footnote_id": footnote_id}
+        # Link the footnote to the paragraph that references it, so the
+        # footnote keeps the context of where it is used in the guide
+        if footnote_id in anchors:
+            anchor_text, anchor_section = anchors[footnote_id]
+            footnote_metadata["anchor_text"] = anchor_text
+            footnote_metadata["anchor_section"] = anchor_section
+        documents.append(Document(page_content=text, metadata=footnote_metadata))
+    return documents
+
+
+def paragraph_content(paragraph):
+    parts = []
+    footnote_ids = []
+    page_breaks = 0
+    for element in paragraph.iter(f"{W}t", f"{W}tab", f"{W}br", f"{W}cr",
+                                  f"{W}footnoteReference", f"{W}lastRenderedPageBreak"):
+        if element.tag == f"{W}t":
+            parts.append(element.text or "")
+        elif element.tag == f"{W}tab":
+            parts.append("\t")
+        elif element.tag == f"{W}br" and element.get(f"{W}type") == "page":
+            page_breaks += 1
+        elif element.tag in (f"{W}br", f"{W}cr"):
+            parts.append("\n")
+        elif element.tag == f"{W}footnoteReference":
+            footnote_ids.append(element.get(f"{W}id"))
+        elif element.tag == f"{W}lastRenderedPageBreak":
+            page_breaks += 1
+    return "".join(parts), footnote_ids, page_breaks
+
+
+def paragraph_category(paragraph):
+    style = paragraph.find(f"{W}pPr/{W}pStyle")
+    style_id = style.get(f"{W}val", "") if style is not None else ""
+    if style_id == "Title":
+        return "Title", 0
+    if style_id.startswith("Heading"):
+        level = style_id[len("Heading"):]
+        return "Title", int(level) - 1 if level.isdigit() else 0
+    if style_id.startswith("List") or paragraph.find(f"{W}pPr/{W}numPr") is not None:
+        return "ListItem", None
+    return "NarrativeText", None
+
+
+def table_rows(table):
+    # Returns the rows of cell texts by grid column, and the (row, column)
+    # positions that only repeat a horizontally merged cell
+    rows = []
+    repeats = set()
+    # Text of vertically merged cells, by grid column, to fill continued cells
+    merged_above = {}
+    for row in table.iterfind(f"{W}tr"):
+        cells = []
+        for cell in row.iterfind(f"{W}tc"):
+            text = " ".join(" ".join(paragraph_content(paragraph)[0].split())
+                            for paragraph in cell.iter(f"{W}p")).strip()
+
+            span = cell.find(f"{W}tcPr/{W}gridSpan")
+            span = int(span.get(f"{W}val", "1")) if span is not None else 1
+            v_merge = cell.find(f"{W}tcPr/{W}vMerge")
+            h_merge = cell.find(f"{W}tcPr/{W}hMerge")
+            column = len(cells)
+            if v_merge is not None and v_merge.get(f"{W}val") != "restart":
+                text = merged_above.get(column, "")
+            elif v_merge is not None:
+                merged_above[column] = text
+            if h_merge is not None and h_merge.get(f"{W}val") != "restart" and cells:
+                # Legacy horizontal merge, continued from the cell on the left
+                text = cells[-1]
+                repeats.add((len(rows), column))
+            # Spanned cells repeat their text in every grid column they cover
+            repeats.update((len(rows), column + offset) for offset in range(1, span))
+            cells.extend([text] * span)
+        rows.append(cells)
+
+    width = max((len(row) for row in rows), default=0)
+    return [row + [""] * (width - len(row)) for row in rows], repeats
+
+
+def table_text(rows, repeats):
+    # Plain text of the table, without the repeats of horizontally merged cells
+    return " ".join(cell for row_index, row in enumerate(rows) for column, cell in enumerate(row)
+                    if cell and (row_index, column) not in repeats)
+
+
+def rows_to_markdown(rows):
+    # Same layout as pandas' DataFrame.to_markdown() on the parsed table: the
+    # first row is the header and rows are numbered from 0
+    def line(cells):
+        return "| " + " | ".join(cell.replace("|", "\\|") for cell in cells) + " |"
+
+    header, body = rows[0], rows[1:]
+    lines = [line([""] + header), "|---:|" + "|".join([":---"] * len(header)) + "|"]
+    lines.extend(line([str(i)] + row) for i, row in enumerate(body))
+    return "\n".join(lines)
+
+
+def _release(element):
+    # Free parsed elements as we go so memory does not grow with the document
+    element.clear()
+    while element.getprevious() is not None:
+        del element.getparent()[0]
+
+
+if __name__ == "__main__":
+    # Benchmark against Unstructured: python -m utils.docx_loader [file]
+    import sys
+    import time
+
+    file_path = sys.argv[1] if len(sys.argv) > 1 else "data/Data Classification Guide.docx"
+
+    start = time.perf_counter()
+    native_documents = load_docx_elements(file_path)
+    native_time = time.perf_counter() - start
+    print(f"Native loader: {len(native_documents)} elements in {native_time * 1000:.1f} ms")
+
+    unanchored = [doc.metadata["footnote_id"] for doc in native_documents
+                  if doc.metadata.get("category") == "References" and "anchor_text" not in doc.metadata]
+    if unanchored:
+        sys.exit(f"Footnotes with no anchor paragraph: {', '.join(unanchored)}")
+
+    start = time.perf_counter()
+    from langchain_community.document_loaders import \
+        UnstructuredWordDocumentLoader
+    from unstructured.partition.docx import partition_docx  # noqa: F401
+    import_time = time.perf_counter() - start
+    start = time.perf_counter()
+    unstructured_documents = UnstructuredWordDocumentLoader(
+        file_path, mode="elements", strategy="fast").load()
+    parse_time = time.perf_counter() - start
+    print(f"Unstructured: {len(unstructured_documents)} elements in {parse_time * 1000:.1f} ms "
+          f"(+ {import_time * 1000:.1f} ms import)")
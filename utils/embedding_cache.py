@@ -0,0 +1,127 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_PATH = "data/kb_cache/embeddings.sqlite"
+EMBEDDING_CACHE_MAX_ENTRIES = 50000
+
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embedding backend with a persistent cache keyed by model name and
+    # text hash, so repeated chunks and queries are only embedded once.
+
+    def __init__(self, embeddings, model, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, timeout=30)
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )""")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.commit()
+
+    def cache_key(self, text):
+        return hashlib.sha256(f"{self.model}\x00{text}".encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self.cache_key(text) for text in texts]
+        cached = self._lookup(set(keys))
+
+        # Identical texts within a batch are only sent to the backend once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = {key: np.asarray(vector, dtype=np.float32)
+                           for key, vector in zip(missing.keys(), vectors)}
+            self._store(new_vectors)
+            cached.update(new_vectors)
+
+        return [list(map(float, cached[key])) for key in keys]
+
+    def embed_query(self, text):
+        key = self.cache_key(text)
+        cached = self._lookup({key})
+        with self._lock:
+            if key in cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if key not in cached:
+            cached[key] = np.asarray(
+                self.embeddings.embed_query(text), dtype=np.float32)
+            self._store({key: cached[key]})
+        return list(map(float, cached[key]))
+
+    def stats(self):
+        with self._lock:
+            size = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": size,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+    def _lookup(self, keys):
+        if not keys:
+            return {}
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            # Stay below SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._connection.commit()
+        return found
+
+    def _store(self, vectors):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, vector.tobytes(), now) for key, vector in vectors.items()])
+
+            # Evict the least recently used entries once the cache is full
+            size = self._connection.execute(
+                "SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            if size > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (size - self.max_entries,))
+            self._connection.commit()
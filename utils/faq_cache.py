@@ -0,0 +1,31 @@
+import re
+
+from utils.classification_cache import ClassificationCache
+
+# Cache of Q&A answers keyed by the standalone question, with the same exact
+# and semantic tiers as the classification cache. Questions that differ only
+# in a classification label ("What is S2?" and "What is S3?") embed almost
+# identically, so a semantic hit also requires the same labels.
+
+FAQ_CACHE_PATH = "data/kb_cache/faq.sqlite"
+
+LABEL_PATTERN = re.compile(
+    r"\b(?:S[123]|SCF|ESF|N[AB]"
+    r"|Class\s+(?:Light\s+Green|Dark\s+Green|Green|Blue|Yellow|Orange|Red|Black))\b",
+    re.IGNORECASE)
+
+
+def question_signature(question):
+    # The classification labels and frameworks a question mentions
+    return ",".join(sorted({" ".join(match.group().upper().split())
+                            for match in LABEL_PATTERN.finditer(question)}))
+
+
+class FAQCache(ClassificationCache):
+
+    def __init__(self, namespace, embed=None, path=FAQ_CACHE_PATH, **kwargs):
+        super().__init__(namespace, embed, path, **kwargs)
+
+    def accepts(self, answer):
+        # Answers are plain text
+        return bool(answer.strip())
@@ -0,0 +1,52 @@
+import re
+
+# Builds the "Downgrade your classification" markdown locally. The model only
+# returns the sensitive substrings, which are located in the original text and
+# bolded, so its output does not grow with the length of the document.
+
+
+def find_spans(text, quotes):
+    # Every occurrence of each quoted substring, as (start, end) offsets. Case
+    # and whitespace differences introduced by the model are tolerated.
+    spans = []
+    for quote in quotes:
+        if not isinstance(quote, str) or not quote.strip():
+            continue
+        pattern = r"\s+".join(re.escape(word) for word in quote.split())
+        spans.extend(match.span() for match in re.finditer(pattern, text, re.IGNORECASE))
+    return spans
+
+
+def merge_spans(spans):
+    # Overlapping or touching spans become one, so the bold markers never nest
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def bold_spans(text, spans):
+    result = ""
+    index = 0
+    for start, end in merge_spans(spans):
+        result += text[index:start]
+        # Markdown only renders bold within a line and without surrounding
+        # whitespace inside the markers
+        for part in re.split(r"(\s*\n\s*)", text[start:end]):
+            if not part.strip():
+                result += part
+                continue
+            stripped = part.strip()
+            leading = part[:len(part) - len(part.lstrip())]
+            trailing = part[len(part.rstrip()):]
+            result += f"{leading}**{stripped}**{trailing}"
+        index = end
+    result += text[index:]
+    return result
+
+
+def highlight_text(text, quotes):
+    return bold_spans(text, find_spans(text, quotes))
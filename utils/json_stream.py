@@ -0,0 +1,140 @@
+import json
+
+# Parses a JSON object while it is still being generated, so each field can be
+# shown as soon as the model emits it. Text before the opening brace (such as
+# a ```json fence) is ignored, like extract_curly_only does for full answers.
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b",
+            "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class IncrementalJSONParser:
+
+    def __init__(self):
+        self.values = {}
+        self.completed = set()
+        self._state = "start"
+        self._key = []
+        self._value = []
+        self._escape = None
+        self._depth = 0
+        self._in_string = False
+
+    @property
+    def done(self):
+        return self._state == "done"
+
+    def feed(self, chunk):
+        # Returns every field seen so far; string fields still being generated
+        # hold the text received so far
+        for char in chunk:
+            self._consume(char)
+        if self._state == "string_value":
+            self.values[self._current_key] = "".join(self._value)
+        return dict(self.values)
+
+    def _consume(self, char):
+        state = self._state
+        if state == "start":
+            if char == "{":
+                self._state = "key_or_end"
+        elif state == "key_or_end":
+            if char == '"':
+                self._key = []
+                self._state = "key"
+            elif char == "}":
+                self._state = "done"
+        elif state == "key":
+            if self._escape is not None:
+                self._read_escape(char, self._key)
+            elif char == "\\":
+                self._escape = ""
+            elif char == '"':
+                self._current_key = "".join(self._key)
+                self._state = "colon"
+            else:
+                self._key.append(char)
+        elif state == "colon":
+            if char == ":":
+                self._state = "value"
+        elif state == "value":
+            if char.isspace():
+                return
+            self._value = []
+            if char == '"':
+                self._state = "string_value"
+            else:
+                self._depth = 0
+                self._in_string = False
+                self._state = "other_value"
+                self._consume_other(char)
+        elif state == "string_value":
+            if self._escape is not None:
+                self._read_escape(char, self._value)
+            elif char == "\\":
+                self._escape = ""
+            elif char == '"':
+                self._finish("".join(self._value))
+                self._state = "after_value"
+            else:
+                self._value.append(char)
+        elif state == "other_value":
+            self._consume_other(char)
+        elif state == "after_value":
+            if char == ",":
+                self._state = "key_or_end"
+            elif char == "}":
+                self._state = "done"
+
+    def _consume_other(self, char):
+        # Numbers, literals, arrays and nested objects are kept as raw text and
+        # decoded once complete
+        if self._in_string:
+            self._value.append(char)
+            if self._escape is not None:
+                self._escape = None
+            elif char == "\\":
+                self._escape = ""
+            elif char == '"':
+                self._in_string = False
+        elif char == '"':
+            self._in_string = True
+            self._value.append(char)
+        elif char in "[{":
+            self._depth += 1
+            self._value.append(char)
+        elif char in "]}" and self._depth > 0:
+            self._depth -= 1
+            self._value.append(char)
+            if self._depth == 0:
+                self._finish_raw()
+                self._state = "after_value"
+        elif char == "}" or (char == "," and self._depth == 0):
+            self._finish_raw()
+            self._state = "done" if char == "}" else "key_or_end"
+        else:
+            self._value.append(char)
+
+    def _read_escape(self, char, target):
+        if self._escape == "" and char != "u":
+            target.append(_ESCAPES.get(char, char))
+            self._escape = None
+            return
+        self._escape += char
+        if len(self._escape) == 5:
+            try:
+                target.append(chr(int(self._escape[1:], 16)))
+            except ValueError:
+                target.append("\\" + self._escape)
+            self._escape = None
+
+    def _finish_raw(self):
+        raw = "".join(self._value).strip()
+        try:
+            self._finish(json.loads(raw))
+        except ValueError:
+            self._finish(raw)
+
+    def _finish(self, value):
+        self.values[self._current_key] = value
+        self.completed.add(self._current_key)
@@ -0,0 +1,147 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Processed chunks and their embeddings are stored on disk so that a cold start
+# only needs to read two files instead of re-parsing and re-embedding the guide.
+SNAPSHOT_DIR = "data/kb_cache"
+SNAPSHOT_VERSION = 1
+
+
+def file_digest(file_path):
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def settings_digest(settings):
+    return hashlib.sha256(json.dumps(
+        {"version": SNAPSHOT_VERSION, **settings}, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def snapshot_key(file_paths, settings):
+    # The key changes whenever a source file or any setting that affects the
+    # chunks or vectors changes, so a stale snapshot is never loaded.
+    # Snapshots built with the same settings share a prefix, which lets an
+    # edited guide, or a manifest with a source added or removed, reuse the
+    # vectors of its previous snapshot.
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    hasher = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        hasher.update(file_path.encode("utf-8"))
+        hasher.update(file_digest(file_path).encode("utf-8"))
+    return f"{settings_digest(settings)}-{hasher.hexdigest()[:16]}"
+
+
+def chunk_fingerprint(doc):
+    # The source is included so a chunk repeated in two guides is kept for each
+    hasher = hashlib.sha256()
+    for part in (doc.page_content, doc.metadata.get("section", ""), doc.metadata.get("category", ""),
+                 doc.metadata.get("source", "")):
+        hasher.update(str(part).encode("utf-8"))
+        hasher.update(b"\x00")
+    return hasher.hexdigest()
+
+
+def find_previous_snapshot(key, snapshot_dir=SNAPSHOT_DIR):
+    # Most recently written snapshot with the same settings as key
+    prefix = key.split("-")[0]
+    candidates = [path for path in glob.glob(os.path.join(snapshot_dir, f"{prefix}-*.json"))
+                  if os.path.basename(path) != f"{key}.json"]
+    for path in sorted(candidates, key=os.path.getmtime, reverse=True):
+        snapshot = load_snapshot(os.path.basename(path)[:-len(".json")], snapshot_dir)
+        if snapshot is not None:
+            return snapshot
+    return None
+
+
+def prune_snapshots(key, snapshot_dir=SNAPSHOT_DIR):
+    # Remove the superseded snapshots built with the same settings as key
+    prefix = key.split("-")[0]
+    for path in glob.glob(os.path.join(snapshot_dir, f"{prefix}-*")):
+        if not os.path.basename(path).startswith(f"{key}."):
+            os.remove(path)
+
+
+def snapshot_paths(key, snapshot_dir=SNAPSHOT_DIR):
+    return (os.path.join(snapshot_dir, f"{key}.json"),
+            os.path.join(snapshot_dir, f"{key}.npy"))
+
+
+def lexical_index_path(key, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f"{key}.bm25.npz")
+
+
+def load_lexical_index_arrays(key, snapshot_dir=SNAPSHOT_DIR):
+    # The arrays saved by save_lexical_index_arrays, or None
+    path = lexical_index_path(key, snapshot_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            return dict(arrays)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable lexical index {key}: {e}")
+        return None
+
+
+def save_lexical_index_arrays(key, arrays, snapshot_dir=SNAPSHOT_DIR):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _atomic_write(lexical_index_path(key, snapshot_dir), lambda f: np.savez(f, **arrays))
+
+
+def load_snapshot(key, snapshot_dir=SNAPSHOT_DIR):
+    chunks_path, vectors_path = snapshot_paths(key, snapshot_dir)
+    if not (os.path.exists(chunks_path) and os.path.exists(vectors_path)):
+        return None
+
+    try:
+        with open(chunks_path, "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        vectors = np.load(vectors_path)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable knowledge base snapshot {key}: {e}")
+        return None
+
+    if len(chunks) != len(vectors):
+        print(f"Ignoring inconsistent knowledge base snapshot {key}")
+        return None
+
+    documents = [Document(page_content=chunk["page_content"], metadata=chunk["metadata"])
+                 for chunk in chunks]
+    return documents, vectors
+
+
+def save_snapshot(key, documents, vectors, snapshot_dir=SNAPSHOT_DIR):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    chunks_path, vectors_path = snapshot_paths(key, snapshot_dir)
+    chunks = [{"page_content": doc.page_content, "metadata": doc.metadata}
+              for doc in documents]
+
+    # The vectors are written before the chunks, and load_snapshot requires both,
+    # so a crash midway never leaves a snapshot that looks complete.
+    _atomic_write(vectors_path, lambda f: np.save(
+        f, np.asarray(vectors, dtype=np.float32)))
+    _atomic_write(chunks_path, lambda f: f.write(
+        json.dumps(chunks, ensure_ascii=False).encode("utf-8")))
+
+
+def _atomic_write(path, write):
+    directory = os.path.dirname(path) or "."
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -1,14 +1,22 @@
-from utils.vectordb_helpers import load_knowledge_base
+from utils.vectordb_helpers import (get_embeddings, load_knowledge_base,
+                                    load_lexical_index)
+from utils.bm25 import HybridRetriever, reciprocal_rank_fusion, tokenize
+from utils.async_runner import iterate_async
+from utils.context_assembly import assemble_context
+import asyncio
+import logging
+import math
 import os
+import threading
+import time
+from collections import deque
 
 import streamlit as st
 from dotenv import load_dotenv
-from langchain.chains import (create_history_aware_retriever,
-                              create_retrieval_chain)
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.prompts import (ChatPromptTemplate, MessagesPlaceholder,
                                PromptTemplate)
-from langchain.retrievers.multi_query import MultiQueryRetriever
+from langchain_core.output_parsers import StrOutputParser
 from langchain_openai import ChatOpenAI
 from openai import OpenAI
 # import logging
@@ -28,19 +36,104 @@ client = OpenAI(api_key=OPENAI_KEY)
 
 llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.0)
 
-vector_store_retriever = load_knowledge_base(
-).as_retriever(search_kwargs={"k": 4}, temperature=0.0)
+logger = logging.getLogger(__name__)
+
+# "vector" for dense retrieval only, "hybrid" to fuse it with BM25, or "auto" to
+# also answer short exact-term queries from BM25 alone
+RETRIEVER_MODE = os.getenv("RETRIEVER_MODE", "hybrid")
+
+# Retrieve with the raw input while the multi-query generation is in flight,
+# and stop waiting for the multi-query retrieval after this many seconds
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+RETRIEVAL_TIME_BUDGET = float(os.getenv("RETRIEVAL_TIME_BUDGET", "8"))
+# Only the start of long inputs is embedded for the speculative retrieval
+SPECULATIVE_QUERY_CHARS = 2000
+# Sections of a large document that are classified at the same time
+MAX_CONCURRENT_SECTIONS = int(os.getenv("MAX_CONCURRENT_SECTIONS", "8"))
+
+vector_store = load_knowledge_base()
+vector_store_retriever = vector_store.as_retriever(
+    search_kwargs={"k": 4}, temperature=0.0)
+
+lexical_index = None
+if RETRIEVER_MODE != "vector":
+    lexical_index = load_lexical_index()
+    vector_store_retriever = HybridRetriever(
+        vector_retriever=vector_store_retriever, lexical_index=lexical_index, k=4, mode=RETRIEVER_MODE)
 
 
 def get_embedding(input, model="text-embedding-3-small"):
-    response = client.embeddings.create(
-        input=input,
-        model=model
-    )
-    return [x.embedding for x in response.data]
+    texts = [input] if isinstance(input, str) else list(input)
+    return get_embeddings(model).embed_documents(texts)
+
+
+# Compiled chains, keyed by pipeline name, prompts, retriever and model.
+# LangChain runnables hold no per-call state, so one instance is safely shared
+# by every Streamlit session and thread.
+_chain_registry = {}
+_chain_registry_lock = threading.Lock()
+_chain_timings = {}
+_chain_timings_lock = threading.Lock()
+
+
+def get_chain(name, key, build):
+    registry_key = (name, id(vector_store_retriever),
+                    getattr(llm, "model_name", None)) + key
+    chain = _chain_registry.get(registry_key)
+    if chain is None:
+        with _chain_registry_lock:
+            chain = _chain_registry.get(registry_key)
+            if chain is None:
+                start = time.perf_counter()
+                chain = build()
+                record_timing(name, "construction", time.perf_counter() - start)
+                _chain_registry[registry_key] = chain
+    return chain
+
+
+def invoke_chain(name, chain, inputs):
+    start = time.perf_counter()
+    try:
+        return chain.invoke(inputs)
+    finally:
+        record_timing(name, "invocation", time.perf_counter() - start)
+
+
+def record_timing(name, stage, seconds):
+    with _chain_timings_lock:
+        timing = _chain_timings.setdefault(
+            (name, stage), {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                            "samples": deque(maxlen=1000)})
+        timing["count"] += 1
+        timing["total_seconds"] += seconds
+        timing["max_seconds"] = max(timing["max_seconds"], seconds)
+        timing["samples"].append(seconds)
+
+
+def get_chain_timings():
+    # {(pipeline name, stage): count, total, max, p50 and p95 seconds}
+    # The percentiles are over the most recent 1000 calls.
+    with _chain_timings_lock:
+        timings = {}
+        for key, value in _chain_timings.items():
+            samples = sorted(value["samples"])
+            timings[key] = {
+                "count": value["count"],
+                "total_seconds": value["total_seconds"],
+                "max_seconds": value["max_seconds"],
+                "p50_seconds": _percentile(samples, 0.5),
+                "p95_seconds": _percentile(samples, 0.95),
+            }
+        return timings
 
 
-def get_qa_completion(retriever_system_prompt, query_system_prompt, user_input, chat_hist):
+def _percentile(sorted_samples, fraction):
+    # Nearest-rank percentile
+    rank = max(math.ceil(fraction * len(sorted_samples)), 1)
+    return sorted_samples[rank - 1]
+
+
+def build_qa_rewrite_chain(retriever_system_prompt):
 
     # Contextualize question
     contextualize_q_prompt = ChatPromptTemplate.from_messages(
@@ -50,11 +143,10 @@ def get_qa_completion(retriever_system_prompt, query_system_prompt, user_input,
             ("user", "{input}"),
         ]
     )
+    return contextualize_q_prompt | llm | StrOutputParser()
 
-    history_aware_retriever = create_history_aware_retriever(
-        llm, vector_store_retriever, contextualize_q_prompt
-    )
 
+def build_qa_answer_chain(query_system_prompt):
     qa_prompt = ChatPromptTemplate.from_messages(
         [
             ("system", query_system_prompt),
@@ -62,27 +154,228 @@ def get_qa_completion(retriever_system_prompt, query_system_prompt, user_input,
             ("user", "{input}"),
         ]
     )
+    return create_stuff_documents_chain(llm, qa_prompt)
+
+
+def build_summary_chain(summary_prompt):
+    return PromptTemplate.from_template(summary_prompt) | llm | StrOutputParser()
+
+
+def get_standalone_question(retriever_system_prompt, user_input, chat_hist):
+    # The question reformulated so it can be understood without the chat history
+    rewrite_chain = get_chain("qa_rewrite", (retriever_system_prompt,),
+                              lambda: build_qa_rewrite_chain(retriever_system_prompt))
+    return invoke_chain("qa_rewrite", rewrite_chain, {"input": user_input, "chat_hist": chat_hist})
+
+
+def summarize_conversation(summary_prompt, summary, messages, words):
+    # Folds messages into the running summary of a conversation
+    summary_chain = get_chain("qa_summary", (summary_prompt,), lambda: build_summary_chain(summary_prompt))
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return invoke_chain("qa_summary", summary_chain,
+                        {"summary": summary or "None yet.", "messages": transcript, "words": words})
+
+
+def retrieve_qa_context(question):
+    # A single query has a single ranking, already fused with BM25 by the
+    # hybrid retriever, so assembling it only stitches, de-duplicates and
+    # applies the token budget
+    return assemble_context([vector_store_retriever.invoke(question)])
+
+
+def get_qa_completion(retriever_system_prompt, query_system_prompt, user_input, chat_hist, question=None):
+    # question is the standalone question used for retrieval, reformulated
+    # from the chat history when not given
+    if question is None:
+        question = get_standalone_question(retriever_system_prompt, user_input, chat_hist)
+    answer_chain = get_chain("qa", (query_system_prompt,), lambda: build_qa_answer_chain(query_system_prompt))
+    start = time.perf_counter()
+    try:
+        context = retrieve_qa_context(question)
+        answer = answer_chain.invoke({"input": user_input, "chat_hist": chat_hist, "context": context})
+    finally:
+        record_timing("qa", "invocation", time.perf_counter() - start)
+    return {"input": user_input, "chat_hist": chat_hist, "context": context, "answer": answer}
+
+
+def stream_qa_completion(retriever_system_prompt, query_system_prompt, user_input, chat_hist, question=None):
+    # Yields {"context": documents} once retrieval is done, then {"answer": token}
+    # for each generated token
+    if question is None:
+        question = get_standalone_question(retriever_system_prompt, user_input, chat_hist)
+    answer_chain = get_chain("qa", (query_system_prompt,), lambda: build_qa_answer_chain(query_system_prompt))
+    start = time.perf_counter()
+    context = retrieve_qa_context(question)
+    yield {"context": context}
+    first_token = True
+    for token in answer_chain.stream({"input": user_input, "chat_hist": chat_hist, "context": context}):
+        if token:
+            if first_token:
+                record_timing("qa", "first_token", time.perf_counter() - start)
+                first_token = False
+            yield {"answer": token}
+    record_timing("qa", "invocation", time.perf_counter() - start)
+
+
+def parse_queries(text):
+    # One query per non-empty line, as LangChain's MultiQueryRetriever parses them
+    return [line.strip() for line in text.strip().split("\n") if line.strip()]
+
+
+def unique_documents(documents):
+    seen = set()
+    unique = []
+    for doc in documents:
+        key = (doc.page_content, tuple(sorted(doc.metadata.items())))
+        if key not in seen:
+            seen.add(key)
+            unique.append(doc)
+    return unique
+
+
+async def aretrieve_for_queries(queries):
+    # Returns the ranking of each query, retrieved concurrently by the same
+    # retriever as Q&A so RETRIEVER_MODE applies to both
+    return list(await asyncio.gather(*(vector_store_retriever.ainvoke(query) for query in queries)))
+
+
+async def timed(name, stage, awaitable):
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        record_timing(name, stage, time.perf_counter() - start)
+
+
+def keyword_queries(text, max_keywords=5):
+    # The rarest terms of the input that appear in the guide, as lexical queries
+    if lexical_index is None:
+        return []
+    terms = {term for term in tokenize(text) if term in lexical_index}
+    return sorted(terms, key=lambda term: lexical_index.idf[term], reverse=True)[:max_keywords]
+
+
+async def aretrieve_speculatively(user_input, k=4):
+    # Retrieval that only needs the raw input, so it can run while the
+    # queries are still being generated. Lexical lookups need no network call.
+    rankings = [await vector_store.asimilarity_search(user_input[:SPECULATIVE_QUERY_CHARS], k=k)]
+    for query in [user_input] + keyword_queries(user_input):
+        rankings.append([doc for doc, _ in lexical_index.search(query, k)]
+                        if lexical_index is not None else [])
+    return unique_documents(reciprocal_rank_fusion(rankings)[:k * 2])
+
+
+async def aretrieve_multi_query(query_chain, user_input):
+    queries = parse_queries(await timed("async_classification", "query_generation",
+                                        query_chain.ainvoke({"question": user_input})))
+    return await aretrieve_for_queries(queries)
+
+
+def get_classification_chains(retriever_system_prompt, query_system_prompt):
+    query_chain = get_chain("classification_queries", (retriever_system_prompt,),
+                            lambda: PromptTemplate.from_template(retriever_system_prompt) | llm | StrOutputParser())
+    classify_chain = get_chain("classification_answer", (query_system_prompt,),
+                               lambda: create_stuff_documents_chain(llm, PromptTemplate.from_template(query_system_prompt)))
+    return query_chain, classify_chain
+
+
+async def aretrieve_classification_context(query_chain, user_input, speculative, time_budget):
+    start = time.perf_counter()
+    if speculative:
+        # Start retrieving with the raw input while the multi-query generation
+        # is in flight. If the multi-query retrieval has not finished within
+        # the time budget, classify with the speculative results alone.
+        speculative_task = asyncio.create_task(aretrieve_speculatively(user_input))
+        multi_query_task = asyncio.create_task(
+            aretrieve_multi_query(query_chain, user_input))
+        try:
+            try:
+                rankings = await asyncio.wait_for(multi_query_task, time_budget)
+            except asyncio.TimeoutError:
+                record_timing("async_classification", "budget_exceeded", time.perf_counter() - start)
+                rankings = []
+            except Exception:
+                # The speculative results are enough to classify with
+                logger.exception("Multi-query retrieval failed, using the speculative retrieval only")
+                rankings = []
+            rankings = rankings + [await speculative_task]
+        finally:
+            # Only still running if this coroutine was cancelled
+            speculative_task.cancel()
+    else:
+        rankings = await aretrieve_multi_query(query_chain, user_input)
+    record_timing("async_classification", "retrieval", time.perf_counter() - start)
+    return assemble_context(rankings)
+
+
+async def aget_classification_completion(retriever_system_prompt, query_system_prompt, user_input, hints="",
+                                         speculative=SPECULATIVE_RETRIEVAL, time_budget=RETRIEVAL_TIME_BUDGET):
+    query_chain, classify_chain = get_classification_chains(
+        retriever_system_prompt, query_system_prompt)
+
+    start = time.perf_counter()
+    context = await aretrieve_classification_context(query_chain, user_input, speculative, time_budget)
+    answer = await timed("async_classification", "answer",
+                         classify_chain.ainvoke({"context": context, "input": user_input, "question": user_input,
+                                                 "hints": hints}))
+    record_timing("async_classification", "invocation", time.perf_counter() - start)
+
+    # Same shape as the response of the retrieval chain
+    return {"input": user_input, "question": user_input, "context": context, "answer": answer}
+
+
+async def astream_classification_completion(retriever_system_prompt, query_system_prompt, user_input, hints="",
+                                            speculative=SPECULATIVE_RETRIEVAL, time_budget=RETRIEVAL_TIME_BUDGET):
+    # Yields {"context": documents} once retrieval is done, then {"answer": token}
+    # for each generated token of the classification
+    query_chain, classify_chain = get_classification_chains(
+        retriever_system_prompt, query_system_prompt)
+
+    start = time.perf_counter()
+    context = await aretrieve_classification_context(query_chain, user_input, speculative, time_budget)
+    yield {"context": context}
+
+    first_token = True
+    async for token in classify_chain.astream({"context": context, "input": user_input, "question": user_input,
+                                               "hints": hints}):
+        if not token:
+            continue
+        if first_token:
+            record_timing("async_classification", "first_token", time.perf_counter() - start)
+            first_token = False
+        yield {"answer": token}
+    record_timing("async_classification", "invocation", time.perf_counter() - start)
+
+
+async def aclassify_sections(retriever_system_prompt, query_system_prompt, sections, section_hints=None,
+                            max_concurrency=MAX_CONCURRENT_SECTIONS):
+    # Yields (index, response) for each section as soon as it is classified, so
+    # the total latency is that of the slowest section rather than the sum
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-    rag_chain = create_retrieval_chain(
-        history_aware_retriever, question_answer_chain)
-    response = rag_chain.invoke({"input": user_input, "chat_hist": chat_hist})
-    return response
+    async def classify(index, section):
+        async with semaphore:
+            return index, await aget_classification_completion(
+                retriever_system_prompt, query_system_prompt, section,
+                section_hints[index] if section_hints else "")
 
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(classify(index, section))
+             for index, section in enumerate(sections)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+    record_timing("sectioned_classification", "invocation", time.perf_counter() - start)
 
-def get_classification_completion(retriever_system_prompt, query_system_prompt, user_input):
-    multiquery_q_prompt = PromptTemplate.from_template(retriever_system_prompt)
 
-    multiquery_retriever = MultiQueryRetriever.from_llm(
-        vector_store_retriever, llm, multiquery_q_prompt)
+def stream_classification_completion(retriever_system_prompt, query_system_prompt, user_input, hints=""):
+    # Streams the async pipeline from the shared event loop into a Streamlit thread
+    return iterate_async(astream_classification_completion(
+        retriever_system_prompt, query_system_prompt, user_input, hints))
 
-    classify_prompt = PromptTemplate.from_template(query_system_prompt)
 
-    classify_chain = create_stuff_documents_chain(
-        llm, classify_prompt)
-    rag_chain = create_retrieval_chain(
-        multiquery_retriever, classify_chain)
-    response = rag_chain.invoke({"input": user_input, "question": user_input})
-    print("Response from RAG:\n")
-    print(response)
-    return response
+def stream_section_classifications(retriever_system_prompt, query_system_prompt, sections, section_hints=None):
+    return iterate_async(aclassify_sections(retriever_system_prompt, query_system_prompt, sections, section_hints))
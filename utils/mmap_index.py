@@ -0,0 +1,134 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+# On-disk index that worker processes open with mmap, so every process on the
+# host shares the same page cache instead of holding its own copy.
+#
+# Layout: magic, header length, JSON header, then 64-byte aligned blocks for
+# the vector matrix, the chunk texts and the chunk metadata. The text and
+# metadata blocks start with count + 1 uint64 offsets into the UTF-8 data
+# that follows, so any single record is decoded without reading the others.
+
+MAGIC = b"DCKBIDX1"
+ALIGNMENT = 64
+
+
+def write_index(path, ids, documents, matrix, dtype):
+    matrix = np.ascontiguousarray(matrix)
+    texts = [doc.page_content.encode("utf-8") for doc in documents]
+    records = [json.dumps({"id": doc_id, "metadata": doc.metadata}, ensure_ascii=False).encode("utf-8")
+               for doc_id, doc in zip(ids, documents)]
+
+    # The header is padded to a fixed size so the block offsets can be computed
+    # before it is serialized
+    header = {"count": len(texts), "dimensions": int(matrix.shape[1]) if matrix.size else 0,
+              "dtype": dtype}
+    header_size = _align(len(MAGIC) + 4 + len(json.dumps(header)) + 200)
+    vectors_offset = header_size
+    texts_offset = _align(vectors_offset + matrix.nbytes)
+    metadata_offset = _align(texts_offset + _block_size(texts))
+    header.update({"vectors_offset": vectors_offset, "texts_offset": texts_offset,
+                   "metadata_offset": metadata_offset})
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+            f.seek(vectors_offset)
+            f.write(matrix.tobytes())
+            f.seek(texts_offset)
+            _write_block(f, texts)
+            f.seek(metadata_offset)
+            _write_block(f, records)
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers either see the previous complete index or the new one
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class MmapIndex:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a knowledge base index")
+        (header_length,) = struct.unpack_from("<I", self._mmap, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self._mmap[start:start + header_length])
+
+        self.count = header["count"]
+        self.dtype = header["dtype"]
+        # A read-only view into the shared pages, no copy is made
+        self.matrix = np.frombuffer(
+            self._mmap, dtype=self.dtype, count=self.count * header["dimensions"],
+            offset=header["vectors_offset"]).reshape(self.count, header["dimensions"])
+        self._texts_offset = header["texts_offset"]
+        self._metadata_offset = header["metadata_offset"]
+        self.ids = [self._record(i)["id"] for i in range(self.count)]
+        self.documents = LazyDocuments(self)
+
+    def text(self, position):
+        return self._read(self._texts_offset, position).decode("utf-8")
+
+    def metadata(self, position):
+        return self._record(position)["metadata"]
+
+    def _record(self, position):
+        return json.loads(self._read(self._metadata_offset, position))
+
+    def _read(self, block_offset, position):
+        start, end = struct.unpack_from("<QQ", self._mmap, block_offset + 8 * position)
+        data_offset = block_offset + 8 * (self.count + 1)
+        return self._mmap[data_offset + start:data_offset + end]
+
+
+class LazyDocuments(Sequence):
+    # Documents are decoded from the index only when they are returned
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return self._index.count
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        return Document(page_content=self._index.text(position),
+                        metadata=self._index.metadata(position))
+
+
+def _block_size(items):
+    return 8 * (len(items) + 1) + sum(len(item) for item in items)
+
+
+def _write_block(f, items):
+    offsets = [0]
+    for item in items:
+        offsets.append(offsets[-1] + len(item))
+    f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+    for item in items:
+        f.write(item)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
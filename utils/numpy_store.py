@@ -0,0 +1,232 @@
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from utils.mmap_index import MmapIndex, write_index
+
+# In-process vector store for small knowledge bases. Vectors are kept as the
+# normalized rows of one contiguous matrix, so an exact cosine top-k search is a
+# single matrix product.
+
+INT8_SCALE = 127.0
+# float16 and int8 rows are converted to float32 this many at a time while
+# searching, so a query never holds a float32 copy of the whole matrix
+SEARCH_BLOCK_ROWS = 1024
+
+
+class NumpyVectorStore(VectorStore):
+
+    def __init__(self, embedding, dtype="float32"):
+        if dtype not in ("float32", "float16", "int8"):
+            raise ValueError(f"Unsupported dtype: {dtype}")
+        self._embedding = embedding
+        self.dtype = dtype
+        self.ids = []
+        self.documents = []
+        self.matrix = None
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, dtype="float32", **kwargs):
+        store = cls(embedding, dtype=dtype)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    @classmethod
+    def from_mmap_index(cls, path, embedding):
+        # The matrix is a read-only view of the mapped file, so it is shared with
+        # every other process that opens the same index
+        index = MmapIndex(path)
+        store = cls(embedding, dtype=index.dtype)
+        store.ids = list(index.ids)
+        store.documents = index.documents
+        store.matrix = index.matrix if index.count else None
+        return store
+
+    def write_mmap_index(self, path):
+        matrix = self.matrix if self.matrix is not None else np.zeros((0, 0), dtype=self.dtype)
+        write_index(path, self.ids, self.documents, matrix, self.dtype)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        documents = [Document(page_content=text, metadata=metadata)
+                     for text, metadata in zip(texts, metadatas)]
+        return self.add_embeddings(documents, self._embedding.embed_documents(texts), ids=ids)
+
+    def add_embeddings(self, documents, vectors, ids=None):
+        # Adds documents with precomputed vectors, without any embedding calls
+        documents = list(documents)
+        if not documents:
+            return []
+        ids = list(ids) if ids is not None else [
+            str(uuid.uuid4()) for _ in documents]
+
+        rows = self._encode(np.asarray(vectors, dtype=np.float32))
+        self.matrix = rows if self.matrix is None else np.vstack(
+            [self.matrix, rows])
+        self.ids.extend(ids)
+        self.documents = list(self.documents) + documents
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        if ids is None:
+            return False
+        to_delete = set(ids)
+        keep = [i for i, doc_id in enumerate(self.ids)
+                if doc_id not in to_delete]
+        self.ids = [self.ids[i] for i in keep]
+        self.documents = [self.documents[i] for i in keep]
+        self.matrix = self.matrix[keep] if keep else None
+        return True
+
+    def get_by_ids(self, ids):
+        positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        return [Document(id=doc_id, page_content=self.documents[positions[doc_id]].page_content,
+                         metadata=self.documents[positions[doc_id]].metadata)
+                for doc_id in ids if doc_id in positions]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter=filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_with_score_by_vector(
+            self._embedding.embed_query(query), k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter=filter)]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):
+        # Scores are cosine similarities, higher is more similar
+        return self.batch_similarity_search_by_vector([embedding], k, filter=filter)[0]
+
+    def batch_similarity_search(self, queries, k=4, filter=None):
+        # All queries are embedded in one call and searched with one matrix product
+        return self.batch_similarity_search_by_vector(
+            self._embedding.embed_documents(list(queries)), k, filter=filter)
+
+    def batch_similarity_search_by_vector(self, embeddings, k=4, filter=None):
+        if self.matrix is None or not len(embeddings):
+            return [[] for _ in embeddings]
+
+        scores = self._scores(self._normalize(np.asarray(embeddings, dtype=np.float32)))
+
+        candidates = np.arange(len(self.ids))
+        if filter:
+            candidates = np.array([i for i, doc in enumerate(self.documents)
+                                   if _matches(doc.metadata, filter)], dtype=np.intp)
+            scores = scores[:, candidates]
+        k = min(k, len(candidates))
+        if k == 0:
+            return [[] for _ in embeddings]
+
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([(self._document(candidates[i]), float(row[i])) for i in top])
+        return results
+
+    def _scores(self, queries):
+        if self.matrix.dtype == np.float32:
+            return queries @ self.matrix.T
+        scores = np.empty((len(queries), len(self.matrix)), dtype=np.float32)
+        for start in range(0, len(self.matrix), SEARCH_BLOCK_ROWS):
+            block = self.matrix[start:start + SEARCH_BLOCK_ROWS]
+            scores[:, start:start + len(block)] = queries @ block.T.astype(np.float32)
+        if self.dtype == "int8":
+            scores /= INT8_SCALE
+        return scores
+
+    def _select_relevance_score_fn(self):
+        return lambda score: (score + 1.0) / 2.0
+
+    def _document(self, position):
+        doc = self.documents[position]
+        return Document(id=self.ids[position], page_content=doc.page_content, metadata=doc.metadata)
+
+    def _encode(self, vectors):
+        rows = self._normalize(vectors)
+        if self.dtype == "int8":
+            return np.ascontiguousarray(np.round(rows * INT8_SCALE).astype(np.int8))
+        return np.ascontiguousarray(rows.astype(self.dtype))
+
+    @staticmethod
+    def _normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+def _matches(metadata, filter):
+    # Supports the subset of Chroma's filter syntax used in this app:
+    # {"field": value} and {"field": {"$in": [values]}}
+    for field, condition in filter.items():
+        value = metadata.get(field)
+        if isinstance(condition, dict):
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+if __name__ == "__main__":
+    # Benchmark against Chroma: python -m utils.numpy_store
+    import subprocess
+    import sys
+    import time
+    import tracemalloc
+
+    from langchain_core.embeddings import FakeEmbeddings
+
+    n, dimensions, queries = 500, 1536, 200
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((n, dimensions)).astype(np.float32)
+    query_vectors = rng.standard_normal((queries, dimensions)).astype(np.float32)
+    documents = [Document(page_content=f"chunk {i}", metadata={"section": f"section {i % 10}"})
+                 for i in range(n)]
+    embedding = FakeEmbeddings(size=dimensions)
+
+    def import_time(module):
+        code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+        return float(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True).stdout)
+
+    def measure(name, build, search):
+        tracemalloc.start()
+        store = build()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.perf_counter()
+        for query in query_vectors:
+            search(store, query)
+        latency = (time.perf_counter() - start) / queries
+        print(f"{name}: {latency * 1000:.3f} ms per query, {peak / 1e6:.1f} MB peak while building")
+
+    for dtype in ("float32", "float16", "int8"):
+        def build(dtype=dtype):
+            store = NumpyVectorStore(embedding, dtype=dtype)
+            store.add_embeddings(documents, vectors)
+            return store
+        measure(f"numpy {dtype}", build,
+                lambda store, query: store.similarity_search_by_vector(query, k=4))
+
+    def build_chroma():
+        from langchain_community.vectorstores import Chroma
+        store = Chroma(embedding_function=embedding, collection_name="benchmark")
+        store._collection.upsert(ids=[str(i) for i in range(n)], embeddings=vectors.tolist(),
+                                 documents=[doc.page_content for doc in documents],
+                                 metadatas=[doc.metadata for doc in documents])
+        return store
+    measure("chroma", build_chroma,
+            lambda store, query: store.similarity_search_by_vector(query.tolist(), k=4))
+
+    print(f"import numpy: {import_time('numpy') * 1000:.0f} ms, "
+          f"import chromadb: {import_time('chromadb') * 1000:.0f} ms")
@@ -0,0 +1,185 @@
+import re
+from bisect import bisect_left
+from functools import lru_cache
+
+# Local detectors for the identifiers Cloak looks for that have a fixed
+# format. Each one is a regular expression, validated with a checksum or
+# format rules where the identifier has them. Free-form entities such as
+# PERSON or SG_ADDRESS are left to Cloak.
+#
+# The patterns are combined into one alternation behind a lookahead on the
+# characters an identifier can start with, so the text is scanned once and
+# most positions are rejected by a single character test. At each position
+# the combined pattern matches, every pattern is tried, and where detections
+# overlap the highest scoring one is kept. Email addresses are anchored on the
+# "@" and extended to the left. Results have the same shape as Cloak's
+# analyze endpoint: entity_type, start, end and score.
+
+NRIC_WEIGHTS = (2, 7, 6, 5, 4, 3, 2)
+NRIC_CHECK_LETTERS = {
+    "S": (0, "JZIHGFEDCBA"),
+    "T": (4, "JZIHGFEDCBA"),
+    "F": (0, "XWUTRQPNMLK"),
+    "G": (4, "XWUTRQPNMLK"),
+    "M": (3, "XWUTRQPNJLK"),
+}
+UEN_ENTITY_TYPES = frozenset("""
+LP LL FC PF RF MQ MM NB CC CS MB FM GS GA GB DP CP NR CM CD MD HS VH CH MH CL
+XL CX RP TU TC FB FN PA PB SS MC SM
+""".split())
+
+ENTITY_PATTERNS = {
+    "URL": r"\bhttps?://[^\s<>\"']+[^\s<>\"'.,;:!?)]",
+    "EMAIL_ADDRESS": r"@[\w-]+(?:\.[\w-]+)*\.[A-Za-z]{2,}\b",
+    "SG_NRIC_FIN": r"(?i:\b[STFGM]\d{7}[A-Z]\b)",
+    "SG_UEN": r"\b(?:\d{8}[A-Z]|(?:19|20)\d{7}[A-Z]|[TSR]\d{2}[A-Z]{2}\d{4}[A-Z])\b",
+    "IP_ADDRESS": r"\b(?:\d{1,3}\.){3}\d{1,3}\b",
+    "CREDIT_CARD": r"\b(?:\d[ -]?){12,18}\d\b",
+    "PHONE_NUMBER": r"(?<![\w+])(?:\+65[ -]?|\(65\) ?|65[ -])?[689]\d{3}[ -]?\d{4}\b",
+    "SG_BANK_ACCOUNT_NUMBER": r"\b(?:\d{3}-\d{5,6}-\d{1,3}|\d{3}-\d{3}-\d{3}-\d|\d{9,12})\b",
+    "SG_ADDRESS_POSTAL_CODE": r"\b(?:(?:Singapore|S)\s?\(?)?\d{6}\b\)?",
+}
+# Characters an identifier can start with. A lowercase NRIC is only tried
+# where the letter is followed by a digit, or every word would be tried.
+START_PATTERN = r"[0-9+(@hSTFGMR]|[stfgm]\d"
+
+ACCOUNT_CONTEXT = re.compile(r"\b(?:account|acct|a/c|bank)\b[^\n]{0,30}$", re.IGNORECASE)
+POSTAL_CONTEXT = re.compile(r"\b(?:postal|postcode|zip)\b[^\n]{0,20}$", re.IGNORECASE)
+POSTAL_PREFIX = re.compile(r"^(?:Singapore|S)\s?\(?")
+EMAIL_LOCAL_PART = re.compile(r"[\w.%+-]{1,64}$")
+
+
+def nric_is_valid(prefix, digits, check):
+    offset, letters = NRIC_CHECK_LETTERS[prefix.upper()]
+    total = offset + sum(int(d) * w for d, w in zip(digits, NRIC_WEIGHTS))
+    return letters[total % 11] == check.upper()
+
+
+def luhn_is_valid(number):
+    digits = [int(d) for d in reversed(number)]
+    total = sum(digits[0::2]) + sum(sum(divmod(2 * d, 10)) for d in digits[1::2])
+    return total % 10 == 0
+
+
+def postal_sector_is_valid(code):
+    # The first two digits are the postal sector, 01 to 82 except 74
+    sector = int(code[:2])
+    return 1 <= sector <= 82 and sector != 74
+
+
+# Each scorer gets the text and the match, and returns (start, end, score),
+# or None when the match is not a valid identifier
+
+def score_email(text, start, end):
+    local_part = EMAIL_LOCAL_PART.search(text, max(0, start - 64), start)
+    if local_part is None:
+        return None
+    return local_part.start(), end, 1.0
+
+
+def score_nric(text, start, end):
+    value = text[start:end].upper()
+    return start, end, 1.0 if nric_is_valid(value[0], value[1:8], value[8]) else 0.4
+
+
+def score_uen(text, start, end):
+    value = text[start:end]
+    if value[0] in "TSR":
+        return start, end, 0.85 if value[3:5] in UEN_ENTITY_TYPES else 0.3
+    return start, end, 0.6 if len(value) == 10 else 0.5
+
+
+def score_ip_address(text, start, end):
+    if all(int(part) <= 255 for part in text[start:end].split(".")):
+        return start, end, 0.6
+    return None
+
+
+def score_credit_card(text, start, end):
+    number = re.sub(r"[ -]", "", text[start:end])
+    if 13 <= len(number) <= 19 and luhn_is_valid(number):
+        return start, end, 0.9
+    return None
+
+
+def score_phone(text, start, end):
+    return start, end, 0.85 if text[start] in "+(6" and end - start > 9 else 0.6
+
+
+def score_bank_account(text, start, end):
+    if "-" in text[start:end]:
+        return start, end, 0.6
+    # Plain digit runs are only accounts when the text says so
+    if ACCOUNT_CONTEXT.search(text, max(0, start - 40), start):
+        return start, end, 0.6
+    return None
+
+
+def score_postal_code(text, start, end):
+    code = re.search(r"\d{6}", text[start:end])
+    if not postal_sector_is_valid(code.group()):
+        return None
+    in_context = POSTAL_PREFIX.match(text[start:end]) or POSTAL_CONTEXT.search(text, max(0, start - 30), start)
+    return start + code.start(), start + code.end(), 0.85 if in_context else 0.3
+
+
+SCORERS = {
+    "URL": lambda text, start, end: (start, end, 0.6),
+    "EMAIL_ADDRESS": score_email,
+    "SG_NRIC_FIN": score_nric,
+    "SG_UEN": score_uen,
+    "IP_ADDRESS": score_ip_address,
+    "CREDIT_CARD": score_credit_card,
+    "PHONE_NUMBER": score_phone,
+    "SG_BANK_ACCOUNT_NUMBER": score_bank_account,
+    "SG_ADDRESS_POSTAL_CODE": score_postal_code,
+}
+SUPPORTED_ENTITIES = frozenset(ENTITY_PATTERNS)
+
+
+@lru_cache(maxsize=None)
+def combined_pattern(entities):
+    alternatives = "|".join(pattern for entity_type, pattern in ENTITY_PATTERNS.items()
+                            if entity_type in entities)
+    return re.compile(f"(?={START_PATTERN})(?:{alternatives})")
+
+
+@lru_cache(maxsize=None)
+def entity_pattern(entity_type):
+    return re.compile(ENTITY_PATTERNS[entity_type])
+
+
+def detect_entities(text, entities=None, score_threshold=0.0):
+    # Where detections overlap, the highest scoring one is kept, so a phone
+    # number is not also reported as a bank account or postal code
+    entities = SUPPORTED_ENTITIES if entities is None else SUPPORTED_ENTITIES.intersection(entities)
+    if not entities:
+        return []
+    scan = combined_pattern(frozenset(entities))
+    patterns = [(entity_type, entity_pattern(entity_type))
+                for entity_type in ENTITY_PATTERNS if entity_type in entities]
+
+    found = []
+    match = scan.search(text)
+    while match is not None:
+        position = match.start()
+        for entity_type, pattern in patterns:
+            candidate = pattern.match(text, position)
+            if candidate is not None:
+                scored = SCORERS[entity_type](text, position, candidate.end())
+                if scored is not None and scored[2] >= score_threshold:
+                    found.append((entity_type, *scored))
+        # Identifiers can start inside a match of another pattern
+        match = scan.search(text, position + 1)
+    found.sort(key=lambda item: (-item[3], item[1]))
+
+    # Kept detections never overlap, so sorted by start their ends are sorted
+    # too and only the neighbours of a new detection need to be checked
+    starts, results = [], []
+    for entity_type, start, end, score in found:
+        index = bisect_left(starts, start)
+        if (index > 0 and results[index - 1]["end"] > start) or (index < len(starts) and starts[index] < end):
+            continue
+        starts.insert(index, start)
+        results.insert(index, {"entity_type": entity_type, "start": start, "end": end, "score": score})
+    return results
@@ -0,0 +1,92 @@
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+import tiktoken
+from langchain_text_splitters import TextSplitter
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o-mini"):
+    # Loading an encoding is expensive, so it is only done once per model
+    return tiktoken.encoding_for_model(model)
+
+
+class TokenOffsetTextSplitter(TextSplitter):
+    # Splits text into chunks of at most chunk_size tokens, preferring to break
+    # on the earliest separator in the list, like RecursiveCharacterTextSplitter.
+    # Each text is encoded once and split points are chosen on token offsets,
+    # so the work grows linearly with the number of tokens.
+
+    def __init__(self, separators=None, model="gpt-4o-mini", **kwargs):
+        super().__init__(**kwargs)
+        self._separators = separators or ["\n\n", "\n", " ", ""]
+        self._model = model
+
+    def split_text(self, text):
+        encoding = get_encoding(self._model)
+        tokens = encoding.encode(text, disallowed_special=())
+        if not tokens:
+            return []
+        _, offsets = encoding.decode_with_offsets(tokens)
+        offsets.append(len(text))
+
+        chunks = []
+        start = 0
+        while start < len(tokens):
+            end = min(start + self._chunk_size, len(tokens))
+            if end < len(tokens):
+                end = self._find_split(text, offsets, start, end)
+
+            chunk = self._chunk(text, offsets, start, end)
+            # Tokens can merge differently across the new chunk boundaries, so
+            # the end is moved back until the chunk re-encodes within
+            # chunk_size and downstream token budgets hold
+            while end - start > 1 and len(encoding.encode(chunk, disallowed_special=())) > self._chunk_size:
+                end = self._find_split(text, offsets, start, end - 1)
+                chunk = self._chunk(text, offsets, start, end)
+            if chunk:
+                chunks.append(chunk)
+
+            if end == len(tokens):
+                break
+            start = self._find_overlap_start(text, offsets, start, end)
+        return chunks
+
+    def _chunk(self, text, offsets, start, end):
+        chunk = text[offsets[start]:offsets[end]]
+        return chunk.strip() if self._strip_whitespace else chunk
+
+    def _find_split(self, text, offsets, start, end):
+        # End the chunk right after the last occurrence of the most preferred
+        # separator. Boundaries within the overlap are skipped so that every
+        # chunk moves the start forward.
+        lowest = start + max(self._chunk_overlap, 0) + 1
+        if lowest >= end:
+            return end
+        for separator in self._separators:
+            if not separator:
+                break
+            position = text.rfind(separator, offsets[lowest], offsets[end])
+            if position == -1:
+                continue
+            # Cut after the token the separator ends, or else before the token
+            # it starts, since tokens can begin with a space
+            after = bisect_left(offsets, position + len(separator), lowest, end)
+            if offsets[after] == position + len(separator):
+                return after
+            before = bisect_right(offsets, position, lowest, end) - 1
+            if before >= lowest:
+                return before
+        return end
+
+    def _find_overlap_start(self, text, offsets, start, end):
+        # Start the next chunk chunk_overlap tokens before the end of this one,
+        # moved forward to the next word boundary so no word is cut in half
+        overlap_start = max(end - self._chunk_overlap, start + 1)
+        word_separators = [separator for separator in self._separators if separator.isspace()]
+        positions = [text.find(separator, offsets[overlap_start], offsets[end])
+                     for separator in word_separators]
+        positions = [position for position in positions if position != -1]
+        if positions:
+            return bisect_left(offsets, min(positions), overlap_start, end)
+        return overlap_start
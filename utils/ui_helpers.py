@@ -20,6 +20,18 @@ def get_color(classification):
     return colors.get(classification, "none")
 
 
+def classification_rank(classification):
+    # Position on the SCF or ESF scale, in the order of colors, with the
+    # Class Yellow sub-classes ordered NA below NB. Unknown values rank lowest.
+    levels = list(colors)
+    base, _, sub_class = classification.partition("(")
+    base = base.strip()
+    if base not in levels:
+        return (-1, 0)
+    sub_class = sub_class.rstrip(") ").strip().upper()
+    return (levels.index(base), ("NA", "NB").index(sub_class) + 1 if sub_class in ("NA", "NB") else 0)
+
+
 def set_stcode_style():
     return st.markdown(
         """
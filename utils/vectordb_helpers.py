@@ -1,65 +1,292 @@
+import json
+import os
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from io import StringIO
 
+import numpy as np
 import pandas as pd
 import streamlit as st
-import tiktoken
 from langchain_community.document_loaders import UnstructuredWordDocumentLoader
-from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from lxml import etree
 
+from utils.bm25 import BM25Index
+from utils.docx_loader import LOADER_VERSION, load_docx_elements
+from utils.embedding_cache import CachedEmbeddings
+from utils.numpy_store import NumpyVectorStore
+from utils.kb_snapshot import (SNAPSHOT_DIR, chunk_fingerprint,
+                               find_previous_snapshot, lexical_index_path,
+                               load_lexical_index_arrays, load_snapshot,
+                               prune_snapshots, save_lexical_index_arrays,
+                               save_snapshot, snapshot_key)
+from utils.token_splitter import TokenOffsetTextSplitter, get_encoding
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+SEPARATORS = ["\n\n", "\n", " ", ""]
+# "native" streams the DOCX XML directly, "unstructured" uses UnstructuredWordDocumentLoader
+DOCUMENT_LOADER = "native"
+SUPPORTED_SOURCE_TYPES = (".docx", ".txt")
+# "chroma", "numpy" for the in-process exact search store (no chromadb needed), or
+# "mmap" for the numpy store backed by an index file shared by all processes
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "chroma")
+# Storage type of the numpy store: "float32", "float16" or "int8"
+NUMPY_STORE_DTYPE = os.getenv("NUMPY_STORE_DTYPE", "float32")
+
 
 def count_tokens(text):
     # This function is for calculating the tokens given the "message"
     # This is simplified implementation that is good enough for a rough estimation
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-    return len(encoding.encode(text))
+    return len(get_encoding().encode(text))
 
 
 def count_tokens_from_messages(messages):
-    encoding = tiktoken.encoding_for_model("gpt-4o-mini")
     value = " ".join([x.get("content") for x in messages])
-    return len(encoding.encode(value))
+    return len(get_encoding().encode(value))
 
 
-text_splitter = RecursiveCharacterTextSplitter(
-    separators=["\n\n", "\n", " ", ""],
-    chunk_size=500,
-    chunk_overlap=50,
-    length_function=count_tokens
+text_splitter = TokenOffsetTextSplitter(
+    separators=SEPARATORS,
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
 )
 
 
-@st.cache_resource(show_spinner=True)
-def load_knowledge_base(file_path="data/Data Classification Guide.docx"):
-
-    loader = UnstructuredWordDocumentLoader(
-        file_path, mode="elements", strategy="fast")
-    documents = loader.load()
+def index_settings(backend=VECTOR_STORE_BACKEND):
+    # Everything that changes the processed chunks, their vectors or how they
+    # are stored
+    return {
+        "embedding_model": EMBEDDING_MODEL,
+        "splitter": "token_offset",
+        "loader": DOCUMENT_LOADER,
+        "loader_version": LOADER_VERSION if DOCUMENT_LOADER == "native" else None,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "separators": SEPARATORS,
+        "store": backend,
+        "store_dtype": NUMPY_STORE_DTYPE if backend in ("numpy", "mmap") else None,
+    }
 
-    documents.extend(extract_footnotes(file_path))
 
-    splitted_documents = text_splitter.split_documents(documents)
+@st.cache_resource(show_spinner=False)
+def get_embeddings(model=EMBEDDING_MODEL):
+    # Shared by indexing and querying so both benefit from the embedding cache
+    return CachedEmbeddings(OpenAIEmbeddings(model=model), model)
 
-    processed_documents = process_for_embedding(splitted_documents)
 
-    # for testing
-    # print_documents_to_file(processed_documents)
+@st.cache_resource(show_spinner=True)
+def load_knowledge_base(file_path="data/Data Classification Guide.docx", incremental=True,
+                        backend=VECTOR_STORE_BACKEND):
+    # file_path can be a single DOCX/TXT file, a directory of them, or a JSON
+    # manifest listing them
+    embeddings = get_embeddings()
 
     try:
-        vector_store = Chroma.from_documents(
-            documents=processed_documents,
-            embedding=OpenAIEmbeddings(model="text-embedding-3-small"),
-        )
+        source_paths = resolve_sources(file_path)
+        key = snapshot_key(source_paths, index_settings(backend))
+        index_path = os.path.join(SNAPSHOT_DIR, f"{key}.idx")
+        if backend == "mmap" and os.path.exists(index_path):
+            # Another process already built the index, map it instead of loading
+            return NumpyVectorStore.from_mmap_index(index_path, embeddings)
+
+        snapshot = load_snapshot(key)
+        if snapshot is not None:
+            processed_documents, vectors = snapshot
+        else:
+            processed_documents = load_and_process_sources(source_paths)
+            previous = find_previous_snapshot(key) if incremental else None
+            vectors, stats = index_documents(
+                processed_documents, embeddings, previous)
+            print(f"Indexed knowledge base: {stats['added']} added, "
+                  f"{stats['removed']} removed, {stats['unchanged']} unchanged")
+            save_snapshot(key, processed_documents, vectors)
+            prune_snapshots(key)
+
+        # for testing
+        # print_documents_to_file(processed_documents)
+
+        vector_store = create_vector_store(
+            processed_documents, vectors, embeddings, backend)
+        # Written before the mmap index, so a process that finds the mmap
+        # index also finds the lexical one
+        if not os.path.exists(lexical_index_path(key)):
+            build_lexical_index(key, vector_store)
+        if backend == "mmap":
+            vector_store.write_mmap_index(index_path)
+            return NumpyVectorStore.from_mmap_index(index_path, embeddings)
         return vector_store
     except Exception as e:
         st.error(f"Error creating vector store: {e}")
         return None
 
 
+def knowledge_base_version(file_path="data/Data Classification Guide.docx"):
+    # Changes whenever the knowledge base is re-indexed, same as its snapshot key
+    return snapshot_key(resolve_sources(file_path), index_settings())
+
+
+@st.cache_resource(show_spinner=False)
+def load_lexical_index(file_path="data/Data Classification Guide.docx"):
+    # BM25 inverted index over the same chunks as the vector store, built by
+    # load_knowledge_base and saved under the same key as its snapshot
+    vector_store = load_knowledge_base(file_path)
+    key = knowledge_base_version(file_path)
+    arrays = load_lexical_index_arrays(key)
+    if arrays is None:
+        # The knowledge base was indexed before lexical indexes were saved
+        return build_lexical_index(key, vector_store)
+
+    ids, documents = get_store_documents(vector_store)
+    stored_ids = [str(doc_id) for doc_id in arrays.pop("ids")]
+    if stored_ids != ids:
+        # The store returned its chunks in another order
+        positions = {doc_id: position for position, doc_id in enumerate(ids)}
+        documents = [documents[positions[doc_id]] for doc_id in stored_ids]
+    return BM25Index.from_arrays(arrays, documents)
+
+
+def build_lexical_index(key, vector_store):
+    ids, documents = get_store_documents(vector_store)
+    index = BM25Index(documents)
+    # The chunk ids map the positions in the index back to the store
+    save_lexical_index_arrays(key, dict(index.to_arrays(), ids=np.array(ids, dtype=str)))
+    return index
+
+
+def get_store_documents(vector_store):
+    # (ids, documents) of every chunk in the store
+    if isinstance(vector_store, NumpyVectorStore):
+        return list(vector_store.ids), vector_store.documents
+    stored = vector_store.get(include=["documents", "metadatas"])
+    return stored["ids"], [Document(page_content=text, metadata=metadata or {})
+                           for text, metadata in zip(stored["documents"], stored["metadatas"])]
+
+
+def resolve_sources(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path)
+                      if name.lower().endswith(SUPPORTED_SOURCE_TYPES))
+    if path.lower().endswith(".json"):
+        # A manifest is a JSON list of paths, relative to the manifest
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        base_directory = os.path.dirname(path)
+        return [os.path.join(base_directory, source) for source in manifest]
+    return [path]
+
+
+def load_and_process_sources(source_paths):
+    # Parsing and splitting is CPU-bound, so each source is processed in its own
+    # process. The chunks of every source are then embedded together.
+    if len(source_paths) == 1:
+        return load_and_process_documents(source_paths[0])
+
+    max_workers = min(len(source_paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(load_and_process_documents, source_paths)
+        return [doc for documents in results for doc in documents]
+
+
+def load_and_process_documents(file_path, document_loader=DOCUMENT_LOADER):
+    if file_path.lower().endswith(".txt"):
+        with open(file_path, "r", encoding="utf-8") as f:
+            documents = [Document(page_content=f.read(), metadata={
+                "source": file_path,
+                "file_directory": os.path.dirname(file_path),
+                "filename": os.path.basename(file_path),
+                "category": "NarrativeText",
+            })]
+    elif document_loader == "native":
+        # Elements, tables (as Markdown) and linked footnotes in a single pass
+        documents = load_docx_elements(file_path)
+    else:
+        loader = UnstructuredWordDocumentLoader(
+            file_path, mode="elements", strategy="fast")
+        documents = loader.load()
+
+        documents.extend(extract_footnotes(file_path))
+
+    splitted_documents = text_splitter.split_documents(documents)
+
+    return process_for_embedding(splitted_documents)
+
+
+def index_documents(documents, embeddings, previous=None):
+    # Reuse the vectors of chunks that are unchanged since the previous snapshot
+    # and only embed the chunks that are new or edited.
+    previous_vectors = {}
+    if previous is not None:
+        for doc, vector in zip(*previous):
+            previous_vectors[chunk_fingerprint(doc)] = vector
+
+    fingerprints = [chunk_fingerprint(doc) for doc in documents]
+    to_embed = {}
+    for fingerprint, doc in zip(fingerprints, documents):
+        if fingerprint not in previous_vectors:
+            to_embed.setdefault(fingerprint, doc.page_content)
+
+    new_vectors = dict(zip(to_embed.keys(), embeddings.embed_documents(
+        list(to_embed.values())))) if to_embed else {}
+
+    vectors = [new_vectors[fingerprint] if fingerprint in new_vectors else previous_vectors[fingerprint]
+               for fingerprint in fingerprints]
+    stats = {
+        "added": len(to_embed),
+        "removed": len(previous_vectors.keys() - set(fingerprints)),
+        "unchanged": len(set(fingerprints) - to_embed.keys()),
+    }
+    return vectors, stats
+
+
+def create_vector_store(documents, vectors, embeddings, backend=VECTOR_STORE_BACKEND):
+    # Load the precomputed vectors directly so that no embedding calls are made;
+    # the embeddings are only used to embed queries at retrieval time.
+    if backend in ("numpy", "mmap"):
+        vector_store = NumpyVectorStore(embeddings, dtype=NUMPY_STORE_DTYPE)
+    else:
+        # Imported here so the numpy backend does not pay for importing chromadb
+        from langchain_community.vectorstores import Chroma
+        vector_store = Chroma(embedding_function=embeddings)
+    sync_vector_store(vector_store, documents, vectors)
+    return vector_store
+
+
+def sync_vector_store(vector_store, documents, vectors):
+    # Chunks are stored under their fingerprints, so syncing a live store with a
+    # re-indexed guide only touches the chunks that were added or removed.
+    # Identical chunks of the same source are stored once.
+    unique = {}
+    for doc, vector in zip(documents, vectors):
+        unique.setdefault(chunk_fingerprint(doc), (doc, vector))
+
+    if isinstance(vector_store, NumpyVectorStore):
+        existing_ids = set(vector_store.ids)
+    else:
+        existing_ids = set(vector_store.get(include=[])["ids"])
+    removed_ids = list(existing_ids - unique.keys())
+    if removed_ids:
+        vector_store.delete(ids=removed_ids)
+
+    added = [(fingerprint, doc, vector) for fingerprint, (doc, vector) in unique.items()
+             if fingerprint not in existing_ids]
+    if added and isinstance(vector_store, NumpyVectorStore):
+        vector_store.add_embeddings(
+            [doc for _, doc, _ in added], [vector for _, _, vector in added],
+            ids=[fingerprint for fingerprint, _, _ in added])
+    elif added:
+        vector_store._collection.upsert(
+            ids=[fingerprint for fingerprint, _, _ in added],
+            embeddings=[list(map(float, vector)) for _, _, vector in added],
+            documents=[doc.page_content for _, doc, _ in added],
+            metadatas=[doc.metadata for _, doc, _ in added],
+        )
+    return {"added": len(added), "removed": len(removed_ids),
+            "unchanged": len(unique) - len(added)}
+
+
 def extract_footnotes(file_path):
     with zipfile.ZipFile(file_path, "r") as docx_zip:
         if "word/footnotes.xml" not in docx_zip.namelist():
@@ -100,7 +327,9 @@ def process_for_embedding(documents):
         elif doc.metadata.get("category") == "Title":
             current_section = doc.page_content.strip()
 
-        doc.metadata["section"] = current_section
+        # Footnotes linked to their anchor paragraph take that paragraph's section
+        doc.metadata["section"] = doc.metadata.pop(
+            "anchor_section", current_section)
         processed_documents.append(doc)
 
     return processed_documents
@@ -123,14 +352,20 @@ def process_table(table_title_doc, table_content_doc):
     # Extract table title from previous document
     table_title = table_title_doc.page_content
 
-    # In table content document, extract text_as_html (already in html format) from metadata
-    table_content = StringIO(table_content_doc.metadata.get("text_as_html"))
-    # Remove text_as_html metadata from table_content_doc
-    if "text_as_html" in table_content_doc.metadata:
-        del table_content_doc.metadata["text_as_html"]
-
-    # Convert to markdown
-    markdown_table = (pd.read_html(table_content, header=0)[0].to_markdown())
+    if "text_as_markdown" in table_content_doc.metadata:
+        # The native loader already converted the table to markdown
+        markdown_table = table_content_doc.metadata.pop("text_as_markdown")
+    else:
+        # In table content document, extract text_as_html (already in html format) from metadata
+        table_content = StringIO(
+            table_content_doc.metadata.get("text_as_html"))
+        # Remove text_as_html metadata from table_content_doc
+        if "text_as_html" in table_content_doc.metadata:
+            del table_content_doc.metadata["text_as_html"]
+
+        # Convert to markdown
+        markdown_table = (pd.read_html(
+            table_content, header=0)[0].to_markdown())
 
     # Merge table title and table content into page_content of table content document
     table_content_doc.page_content = f"[{table_title}]\n" + \